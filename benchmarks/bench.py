@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+GitTail benchmarks
+
+Generates synthetic repositories and measures the stages of a poll cycle:
+repo discovery, running git, parsing, picking new commits, rendering and
+notifying, as well as complete poll cycles and peak memory use, for a range
+of repo counts. Remote polling is measured offline using fake_ssh.
+
+    python benchmarks/bench.py --repos 10,100,1000 --commits 20
+"""
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_path, "..", "gittail"))
+
+from gittail import GitTail
+
+
+"""
+Creates count bare repos with commits commits each in path, using
+git fast-import. Existing repos generated with the same parameters are
+reused.
+"""
+def generate_repos(path, count, commits):
+    marker = os.path.join(path, ".bench-%d-%d" % (count, commits))
+    if os.path.exists(marker):
+        return
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    now = int(time.time())
+    for i in range(0, count):
+        repo = os.path.join(path, "repo%05d.git" % i)
+        subprocess.check_call(["git", "init", "-q", "--bare", repo])
+        stream = []
+        for j in range(0, commits):
+            timestamp = now - (commits - j) * 60
+            message = "Commit %d of repo %d | with a pipe" % (j, i)
+            stream.append("commit refs/heads/master")
+            stream.append("author Author %d <author%d@example.com> %d +0000" % (j % 5, j % 5, timestamp))
+            stream.append("committer Committer <committer@example.com> %d +0000" % timestamp)
+            stream.append("data %d" % len(message))
+            stream.append(message)
+            stream.append("")
+        add_commits(repo, stream)
+    open(marker, "w").close()
+
+
+def add_commits(repo, stream):
+    p = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=repo,
+        stdin=subprocess.PIPE)
+    p.communicate("\n".join(stream) + "\n")
+    if p.returncode != 0:
+        raise RuntimeError("git fast-import failed in %s" % repo)
+
+
+"""
+Adds a commit to every step:th repo, to simulate activity between polls
+"""
+def push_commits(path, count, step):
+    now = int(time.time())
+    pushed = 0
+    for i in range(0, count, step):
+        repo = os.path.join(path, "repo%05d.git" % i)
+        message = "Pushed at %d" % now
+        add_commits(repo, [
+            "commit refs/heads/master",
+            "committer Committer <committer@example.com> %d +0000" % now,
+            "data %d" % len(message),
+            message,
+            "from refs/heads/master^0",
+            "",
+        ])
+        pushed += 1
+    return pushed
+
+
+class NullBackend():
+    def __init__(self):
+        self.Notification = self
+
+    def new(self, *args):
+        return self
+
+    def notify(self, *args):
+        pass
+
+    def show(self):
+        pass
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+"""
+Runs a command with script on its standard input and returns its output
+"""
+def run_script(args, script):
+    p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = p.communicate(script)[0]
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, args)
+    return output
+
+
+def make_gittail(path, transport):
+    spec = {"base_path": path, "pattern": "*"}
+    config = {
+        "use_growl": False,
+        "use_libnotify": False,
+        "watch_local_repos": False,
+        "quiet": 1,
+        "poll_workers": 1,
+    }
+    if transport == "ssh":
+        config["ssh_hosts"] = [{"host": "bench", "repos": [spec]}]
+    else:
+        config["local_repos"] = [spec]
+    return GitTail(config=config), spec
+
+
+"""
+Measures the stages of a poll cycle for count repos and returns the results
+"""
+def run_scale(workdir, count, commits, transport):
+    results = {"repos": count, "commits": commits, "transport": transport}
+    path = os.path.join(workdir, "repos-%d" % count)
+    results["generate"], _ = timed(generate_repos, path, count, commits)
+
+    gittail, spec = make_gittail(path, transport)
+    devnull = open(os.devnull, "w")
+
+    # repo discovery on its own
+    discovery = 'cd %s ; for repo in $( ls -d * ) ; do ' \
+        'if [[ -d $repo && ( ${repo##*.} == "git" || -d $repo/.git ) ]] ; ' \
+        'then echo "repo=$repo" ; fi ; done' % path
+    results["discovery"], _ = timed(subprocess.check_call,
+        ["/bin/bash", "-c", discovery], stdout=devnull)
+
+    # running git, without parsing the output
+    command = gittail._repo_iteration_command(spec)
+    if transport == "ssh":
+        args = gittail._ssh_args({"host": "bench"}) + ["/bin/bash -s"]
+    else:
+        args = ["/bin/bash", "-s"]
+    results["git_exec"], output = timed(run_script, args,
+        gittail._script_input(command))
+    results["bytes"] = len(output)
+
+    results["parse"], records = timed(list,
+        gittail._read_git_log_records(output.splitlines(True)))
+    results["dedupe"], new_commits = timed(gittail._parse_git_log_result,
+        records, repo=spec)
+    results["new_commits"] = len(new_commits)
+
+    sample = new_commits[0:1000]
+    targets = ['console', 'growl', 'libnotify']
+    start = time.time()
+    for commit in sample:
+        gittail._render_messages('commit', {'commit': commit}, targets)
+    gittail._render_messages('commit_digest', {'commits': new_commits}, targets)
+    results["render"] = time.time() - start
+    results["rendered"] = len(sample) + 1
+
+    gittail._config_value["use_growl"] = True
+    gittail._config_value["use_libnotify"] = True
+    # the stubs replace the backends, which must not be loaded
+    gittail._notifiers_loaded = True
+    gittail.growler = gittail.libnotify = NullBackend()
+    stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        start = time.time()
+        for commit in sample:
+            gittail.notify('commit', {'commit': commit})
+        results["notify"] = time.time() - start
+    finally:
+        sys.stdout = stdout
+
+    # complete poll cycles: first run, after pushes to 1% of the repos,
+    # and with nothing changed
+    gittail, spec = make_gittail(path, transport)
+    sys.stdout = devnull
+    try:
+        results["cycle_first"], _ = timed(gittail.poll)
+        results["pushed"] = push_commits(path, count, 100)
+        results["cycle_changed"], _ = timed(gittail.poll)
+        results["cycle_idle"], _ = timed(gittail.poll)
+    finally:
+        sys.stdout = stdout
+
+    # the generated repos have moved on
+    os.remove(os.path.join(path, ".bench-%d-%d" % (count, commits)))
+
+    # kilobytes on Linux
+    results["peak_memory_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+COLUMNS = [
+    ("repos", "%7d"),
+    ("discovery", "%9.3f"),
+    ("git_exec", "%9.3f"),
+    ("parse", "%9.3f"),
+    ("dedupe", "%9.3f"),
+    ("render", "%9.3f"),
+    ("notify", "%9.3f"),
+    ("cycle_first", "%11.3f"),
+    ("cycle_changed", "%13.3f"),
+    ("cycle_idle", "%10.3f"),
+    ("bytes", "%10d"),
+    ("peak_memory_kb", "%14d"),
+]
+
+
+def print_table(rows):
+    print " ".join([("%" + fmt[1:].split(".")[0].rstrip("sd") + "s") % name
+                    for name, fmt in COLUMNS])
+    for row in rows:
+        print " ".join([fmt % row[name] for name, fmt in COLUMNS])
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the stages of a GitTail poll cycle")
+    parser.add_argument('--repos', default='10,100,1000',
+        help='comma separated list of repo counts (default: 10,100,1000)')
+    parser.add_argument('--commits', type=int, default=20,
+        help='commits per repo (default: 20)')
+    parser.add_argument('--transport', choices=['local', 'ssh'], default='local',
+        help='poll the repos directly or through fake_ssh (default: local)')
+    parser.add_argument('--latency', type=float, default=0,
+        help='seconds added to every fake SSH connection')
+    parser.add_argument('--workdir',
+        help='directory for the generated repos, kept between runs')
+    parser.add_argument('--json', action='store_true',
+        help='print one JSON object per repo count instead of a table')
+    parser.add_argument('--scale', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), "gittail-bench")
+
+    if args.scale:
+        # a single repo count, run in its own process to measure peak memory
+        print json.dumps(run_scale(workdir, args.scale, args.commits, args.transport))
+        return
+
+    env = dict(os.environ)
+    if args.transport == "ssh":
+        bin_path = os.path.join(workdir, "bin")
+        if not os.path.isdir(bin_path):
+            os.makedirs(bin_path)
+        shutil.copy(os.path.join(bench_path, "fake_ssh"), os.path.join(bin_path, "ssh"))
+        env["PATH"] = bin_path + os.pathsep + env["PATH"]
+        env["GITTAIL_FAKE_SSH_LATENCY"] = str(args.latency)
+
+    rows = []
+    for count in [int(count) for count in args.repos.split(",")]:
+        output = subprocess.check_output([sys.executable, __file__,
+            "--scale", str(count), "--commits", str(args.commits),
+            "--transport", args.transport, "--workdir", workdir], env=env)
+        row = json.loads(output.strip().split("\n")[-1])
+        rows.append(row)
+        if args.json:
+            print json.dumps(row)
+            sys.stdout.flush()
+
+    if not args.json:
+        print "Seconds per stage, %d commits per repo, %s transport" % (
+            args.commits, args.transport)
+        print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Compact records of the commits GitTail lists. The repo, author and committer
+strings of a record are shared with every other record naming the same ones,
+and the commit's URL is only built when it is asked for.
+"""
+
+
+# string -> the same string, see intern_string()
+_strings = {}
+
+
+"""
+Returns the copy of value that is shared by all commit records. Works for
+unicode strings too, unlike intern(). The strings are never forgotten, which
+is fine for repo and people names, but not for subjects.
+"""
+def intern_string(value):
+    return _strings.setdefault(value, value)
+
+
+"""
+A commit found by polling. The fields are attributes, and can also be read
+the way the dicts that were used before are read, e.g. commit['repo'] or
+commit.has_key('url'), so that templates need not change. dict(commit)
+converts it to a dict, e.g. to send it as JSON.
+
+url is built from the "gitweb_baseurl" or "github_paths" of the repo spec
+the commit was found by, if any.
+"""
+class Commit(object):
+    __slots__ = ('hash', 'committer', 'author', 'commit_time', 'subject',
+        'repo', 'time', 'spec', '_url')
+
+    # the fields listed by git log, in the order of the arguments of
+    # __init__()
+    fields = ('hash', 'committer', 'author', 'commit_time', 'subject')
+
+    # the keys of the mapping view, in the order keys() lists them
+    _keys = fields + ('repo', 'time', 'url')
+
+
+    def __init__(self, hash, committer, author, commit_time, subject):
+        self.hash = hash
+        self.committer = intern_string(committer)
+        self.author = intern_string(author)
+        self.commit_time = commit_time
+        self.subject = subject
+        self.repo = None
+        self.time = None
+        self.spec = None
+        self._url = None
+
+
+    def _get_url(self):
+        if self._url is not None:
+            return self._url
+        if self.spec is None or self.repo is None:
+            return None
+        if self.spec.has_key('gitweb_baseurl'):
+            return "%s?p=%s;a=commitdiff;h=%s" % (
+                self.spec['gitweb_baseurl'], self.repo, self.hash)
+        github_path = self.spec.get('github_paths', {}).get(self.repo)
+        if github_path is not None:
+            return "https://github.com/%s/commit/%s" % (github_path, self.hash)
+        return None
+
+
+    def _set_url(self, url):
+        self._url = url
+
+
+    url = property(_get_url, _set_url)
+
+
+    def __getitem__(self, key):
+        if key in self._keys:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+
+    def __setitem__(self, key, value):
+        if key not in self._keys:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def has_key(self, key):
+        return self.get(key) is not None
+
+
+    __contains__ = has_key
+
+
+    def keys(self):
+        return [key for key in self._keys if self.get(key) is not None]
+
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def __repr__(self):
+        return repr(dict(self.items()))
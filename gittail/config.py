@@ -7,6 +7,7 @@ ssh_hosts = [
         "host": "example.com",
         # "port": 22,
         # "user": "foo",
+        # "ssh_helper": True,
         "repos": [
             # Construct the path so that `ls -d $base_path/$pattern`
             # enumerates the repos you want to watch.
@@ -41,12 +42,171 @@ local_repos= [
 # poll_interval = 60
 
 
+# Watch the refs of local repos with inotify and check a repo right away when
+# they change, instead of waiting for the next poll. Changes arriving within
+# watch_debounce seconds of each other are checked together.
+#
+# watch_local_repos = True    # Linux (default: if inotify is available)
+# watch_debounce = 0.5        # (default: 0.5)
+
+
+# Poll each repo spec on its own schedule: more often while new commits keep
+# turning up, less often while it stays idle, and with exponential backoff
+# while polling it fails. Intervals vary randomly by up to poll_jitter
+# (a fraction) so that repo specs are not all polled at the same moment.
+#
+# adaptive_polling = False    # (default: False)
+# poll_interval_min = 15      # (default: poll_interval / 4)
+# poll_interval_max = 600     # (default: poll_interval * 10)
+# poll_jitter = 0.1           # (default: 0.1)
+
+
+# Skip running git log in repos whose refs have not changed since the
+# previous poll. Each repo's refs are fingerprinted with `git show-ref`.
+#
+# detect_ref_changes = True   # (default: True)
+
+
+# Only list the commits added since the previous poll, by remembering the
+# tip of every ref, instead of listing the last day of commits every time.
+#
+# incremental_log = True      # (default: True)
+
+
+# How long, in seconds, and how many of the commits seen are remembered,
+# to avoid notifying about the same commit twice. Should cover the day of
+# commits that is listed when GitTail starts.
+#
+# seen_commits_max_age = 172800     # (default: 2 days)
+# seen_commits_max_size = 100000    # (default: 100000)
+
+
+# File in which GitTail keeps the commits it has seen and the state of every
+# repo between runs. When set, a restarted GitTail only reports the commits
+# added while it was not running, instead of the last day of commits.
+#
+# state_file = '~/.gittail.sqlite'   # (default: not set)
+
+
+# Remember the repos found under each base path, and only look for repos
+# again when the base path directory has been modified, or every
+# discovery_interval seconds. The latter matters for patterns reaching into
+# subdirectories, e.g. "*/*.git", whose changes do not touch the base path.
+#
+# discovery_cache = True      # (default: True)
+# discovery_interval = 3600   # (default: 3600)
+
+
+# Read the refs and commits of local repos directly from their files instead
+# of running bash and git, so that polling local repos does not create any
+# processes. Repos using features the reader does not support, such as
+# alternates or the reftable format, are still polled with git. The most
+# recently read native_reader_cache_size commits are kept in memory.
+#
+# native_local_reader = True        # (default: True)
+# native_reader_cache_size = 10000  # (default: 10000)
+
+
+# Accept notices of pushes from post-receive hooks at host:port (HTTP) or at
+# the path of a Unix socket, and fetch the pushed commits right away. Polls
+# then only catch what the hooks missed, every push_poll_interval seconds.
+# See README.md for a hook.
+#
+# push_address = '127.0.0.1:7779'   # (default: not set)
+# push_poll_interval = 900          # (default: 900)
+
+
+# Number of batches of new commits kept by a GitTail started with --serve,
+# for subscribers that connect later or reconnect.
+#
+# publish_replay_size = 100   # (default: 100)
+
+
+# Number of repo specs polled simultaneously, and the maximum number of
+# simultaneous polls against any single host. Results are merged in
+# configuration order, so notifications are the same as when polling
+# one repo spec at a time.
+#
+# poll_workers = 1            # (default: 1)
+# poll_host_concurrency = 4   # (default: 4)
+
+
 # The amount of simultaneous new commits required, to trigger
 # digest notification instead of individual notifications.
 #
 # digest_threshold = 10   # (default: 10)
 
 
+# Send notifications from a background thread, so that slow notification
+# backends never delay polling. New commits of the same repo arriving within
+# notify_coalesce_window seconds are sent as one digest, and at most
+# notify_rate_limit popups per minute are shown per backend.
+#
+# async_notifications = False   # (default: False)
+# notify_queue_size = 100       # (default: 100)
+# notify_coalesce_window = 2    # (default: 2)
+# notify_rate_limit = 10        # (default: 10)
+
+
+# SSH connection sharing
+# GitTail keeps one connection per SSH host open between polls
+# (OpenSSH ControlMaster) and sends each poll over it, instead of logging in
+# again for every repo on every poll. Dead connections are reopened
+# automatically. Connections are closed after ssh_control_persist seconds
+# without use. A connection is given up after ssh_server_alive_count_max
+# keepalives, sent every ssh_server_alive_interval seconds, go unanswered,
+# and after a poll through it fails or times out. Both keepalive settings
+# can also be set per host in ssh_hosts.
+#
+# ssh_multiplex = True                # (default: True, except on Windows/Cygwin)
+# ssh_control_persist = 600           # (default: 600)
+# ssh_control_dir = '/tmp/gittail-1000'
+# ssh_server_alive_interval = 15      # (default: 15)
+# ssh_server_alive_count_max = 3      # (default: 3)
+
+
+# Install a small Python helper script on SSH hosts (in ~/.gittail) and poll
+# through it, instead of running a shell loop and git log in every repo. The
+# helper remembers the refs of every repo on the host and only lists the
+# commits added since the previous poll. Requires Python on the host. Can
+# also be enabled per host in ssh_hosts.
+#
+# ssh_helper = False          # (default: False)
+
+
+# Poll all repos of an SSH host with a single command over one connection,
+# instead of one command per entry in "repos". command_timeout then applies
+# to the command as a whole. Can also be set per host in ssh_hosts.
+#
+# batch_repo_specs = True     # (default: True)
+
+
+# Deadlines, in seconds, for establishing an SSH connection and for running
+# the commands of a poll. A poll that takes longer is killed. Both can also
+# be set per host in ssh_hosts, e.g. {"host": "example.com",
+# "command_timeout": 30, ...}.
+#
+# connect_timeout = 10        # (default: 10)
+# command_timeout = 300       # (default: 300)
+
+
+# A host is skipped for circuit_breaker_cooldown seconds after
+# circuit_breaker_failures consecutive failed polls.
+#
+# circuit_breaker_failures = 3      # (default: 3)
+# circuit_breaker_cooldown = 300    # (default: 300)
+
+
+# Poll metrics: durations, bytes read, commits found and errors per repo spec.
+# They can be written to a file in the Prometheus text format after every
+# poll cycle (e.g. for the node_exporter textfile collector), served over
+# HTTP on localhost, and appended to a JSON lines file, one line per cycle.
+#
+# metrics_file = '/var/lib/node_exporter/gittail.prom'   # (default: not set)
+# metrics_port = 9123                                    # (default: not set)
+# metrics_jsonl = '~/gittail-metrics.jsonl'              # (default: not set)
+
+
 # Growl configuration
 #
 # use_growl = True        # OS X, Windows (default: if module exists)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Delivers GitTail notifications from a background thread, so that slow
+notification backends do not hold up polling.
+"""
+
+import Queue
+import threading
+import time
+
+
+"""
+Token bucket allowing rate events per period seconds on average,
+and bursts of up to rate events
+"""
+class RateLimiter():
+    def __init__(self, rate, period):
+        self.rate = rate
+        self.period = float(period)
+        self._tokens = float(rate)
+        self._updated = time.time()
+
+
+    def allow(self, now=None):
+        if now is None:
+            now = time.time()
+        self._tokens = min(self.rate,
+            self._tokens + (now - self._updated) * self.rate / self.period)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+"""
+Queue of pending notifications, worked off by a background thread
+
+Commits handed to add_commits() are held for coalesce_window seconds, and
+the commits of the same repo that arrive meanwhile are sent as one digest.
+Notifications beyond rate_limit per minute are not sent to the popup
+backends (but still shown in the console).
+
+deliver(message_type, data, allow) sends a notification to every target for
+which allow(target) is true, see GitTail.notify().
+"""
+class NotificationDispatcher():
+    def __init__(self, deliver, log, queue_size=100, coalesce_window=2,
+            rate_limit=10):
+        self.deliver = deliver
+        self.log = log
+        self.coalesce_window = coalesce_window
+        self.rate_limit = rate_limit
+        self._queue = Queue.Queue(queue_size)
+        self._limiters = {}
+        # repo -> (time of the first commit, commits), in arrival order
+        self._pending = {}
+        self._pending_order = []
+
+        self._thread = threading.Thread(target=self._run,
+            name="GitTail notifications")
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    """
+    Queues a notification to be sent as is
+    """
+    def add(self, message_type, data):
+        self._put(('notify', message_type, data))
+
+
+    """
+    Queues new commits to be coalesced per repo
+    """
+    def add_commits(self, commits):
+        if commits:
+            self._put(('commits', commits))
+
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            self.log("Notification queue full, dropping notification")
+
+
+    """
+    Sends everything still pending and stops the background thread
+    """
+    def stop(self, timeout=10):
+        self._queue.put(('stop',))
+        self._thread.join(timeout)
+
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self._pending_order:
+                first_seen = self._pending[self._pending_order[0]][0]
+                timeout = max(0, first_seen + self.coalesce_window - time.time())
+            try:
+                item = self._queue.get(True, timeout)
+            except Queue.Empty:
+                item = None
+
+            try:
+                if item is None:
+                    self._flush(time.time())
+                elif item[0] == 'stop':
+                    self._flush(None)
+                    return
+                elif item[0] == 'commits':
+                    now = time.time()
+                    for commit in item[1]:
+                        repo = commit['repo']
+                        if not self._pending.has_key(repo):
+                            self._pending[repo] = (now, [])
+                            self._pending_order.append(repo)
+                        self._pending[repo][1].append(commit)
+                elif item[0] == 'notify':
+                    # keep notifications in the order they were queued
+                    self._flush(None)
+                    self._send(item[1], item[2])
+            except Exception, e:
+                self.log("Exception when sending notification: %s" % e)
+
+
+    """
+    Sends the pending commits of every repo whose coalesce window has passed
+    at the given time, or of every repo if now is None
+    """
+    def _flush(self, now):
+        while self._pending_order:
+            repo = self._pending_order[0]
+            first_seen, commits = self._pending[repo]
+            if now is not None and first_seen + self.coalesce_window > now:
+                return
+            self._pending_order.pop(0)
+            del self._pending[repo]
+            if len(commits) == 1:
+                self._send('commit', {'commit': commits[0]})
+            else:
+                self._send('commit_digest', {
+                    'commits': commits,
+                    'title': '%d new commits in %s' % (len(commits), repo),
+                })
+
+
+    def _send(self, message_type, data):
+        self.deliver(message_type, data, self._allow)
+
+
+    def _allow(self, target):
+        if target == 'console' or not self.rate_limit:
+            return True
+        if not self._limiters.has_key(target):
+            self._limiters[target] = RateLimiter(self.rate_limit, 60)
+        if self._limiters[target].allow():
+            return True
+        self.log("Rate limit reached, not sending notification to %s" % target, 1)
+        return False
@@ -0,0 +1,664 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Reads the refs and commits of local repositories without running git, so
+that polling local repositories does not create any processes. Loose refs,
+packed-refs, loose objects and version 2 pack files are supported. Anything
+else raises UnsupportedRepository, and the caller polls the repository with
+git instead.
+"""
+
+import binascii
+import collections
+import errno
+import glob
+import heapq
+import os
+import struct
+import threading
+import zlib
+
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+OBJECT_TYPES = {
+    'commit': OBJ_COMMIT,
+    'tree': OBJ_TREE,
+    'blob': OBJ_BLOB,
+    'tag': OBJ_TAG,
+}
+
+# Characters with a meaning to bash that glob does not know
+SHELL_PATTERN_CHARACTERS = "{}$~`\\'\" "
+
+_crc_table = []
+for i in range(0, 256):
+    c = i << 24
+    for j in range(0, 8):
+        if c & 0x80000000:
+            c = ((c << 1) ^ 0x04C11DB7) & 0xffffffff
+        else:
+            c = (c << 1) & 0xffffffff
+    _crc_table.append(c)
+
+
+class UnsupportedRepository(Exception):
+    pass
+
+
+"""
+Returns the checksum printed by cksum for data
+"""
+def cksum(data):
+    crc = 0
+    table = _crc_table
+    for c in data:
+        crc = ((crc << 8) & 0xffffffff) ^ table[(crc >> 24) ^ ord(c)]
+    length = len(data)
+    while length:
+        crc = ((crc << 8) & 0xffffffff) ^ table[(crc >> 24) ^ (length & 0xff)]
+        length >>= 8
+    return "%d %d" % (~crc & 0xffffffff, len(data))
+
+
+"""
+Returns the names of the repositories in base_path matching the shell
+pattern, like the repo iteration command of GitTail does with ls -d
+"""
+def list_repos(base_path, pattern):
+    for c in SHELL_PATTERN_CHARACTERS:
+        if c in pattern:
+            raise UnsupportedRepository("pattern %s needs a shell" % pattern)
+    names = []
+    for path in sorted(glob.glob(os.path.join(base_path, pattern))):
+        name = os.path.relpath(path, base_path)
+        if not os.path.isdir(path):
+            continue
+        if name.split(".")[-1] == "git" or os.path.isdir(os.path.join(path, ".git")):
+            names.append(name)
+    return names
+
+
+"""
+Least recently used cache with at most max_size entries, shared by threads
+"""
+class ObjectCache():
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return None
+            self._items[key] = value
+            return value
+
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(False)
+
+
+"""
+The object offsets of a version 2 pack index
+"""
+class PackIndex():
+    def __init__(self, path):
+        f = open(path, "rb")
+        try:
+            self.data = f.read()
+        finally:
+            f.close()
+        if self.data[0:4] != "\377tOc" or struct.unpack(">I", self.data[4:8])[0] != 2:
+            raise UnsupportedRepository("unsupported pack index %s" % path)
+        self.fanout = struct.unpack(">256I", self.data[8:1032])
+        self.count = self.fanout[255]
+        self._offsets = 1032 + 24 * self.count
+        self._large_offsets = self._offsets + 4 * self.count
+
+
+    """
+    Returns the offset of an object in the pack, or None if the pack does
+    not contain it
+    """
+    def find(self, sha):
+        first = ord(sha[0])
+        if first:
+            low = self.fanout[first - 1]
+        else:
+            low = 0
+        high = self.fanout[first]
+        data = self.data
+        while low < high:
+            middle = (low + high) // 2
+            position = 1032 + 20 * middle
+            current = data[position:position + 20]
+            if current < sha:
+                low = middle + 1
+            elif current > sha:
+                high = middle
+            else:
+                offset = struct.unpack_from(">I", data, self._offsets + 4 * middle)[0]
+                if offset & 0x80000000:
+                    offset = struct.unpack_from(">Q", data,
+                        self._large_offsets + 8 * (offset & 0x7fffffff))[0]
+                return offset
+        return None
+
+
+class Pack():
+    def __init__(self, path, base_cache):
+        self.index = PackIndex(path + ".idx")
+        self.file = open(path + ".pack", "rb")
+        self.base_cache = base_cache
+        self._lock = threading.Lock()
+
+
+    """
+    Returns the type and data of the object at offset
+    """
+    def read(self, offset, find):
+        cached = self.base_cache.get((self, offset))
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            self.file.seek(offset)
+            chunk = self.file.read(4096)
+            position = 0
+            c = ord(chunk[position])
+            object_type = (c >> 4) & 7
+            size = c & 15
+            shift = 4
+            while c & 0x80:
+                position += 1
+                c = ord(chunk[position])
+                size |= (c & 0x7f) << shift
+                shift += 7
+            position += 1
+
+            base = None
+            if object_type == OBJ_OFS_DELTA:
+                c = ord(chunk[position])
+                distance = c & 0x7f
+                while c & 0x80:
+                    position += 1
+                    c = ord(chunk[position])
+                    distance = ((distance + 1) << 7) | (c & 0x7f)
+                position += 1
+                base = (offset - distance, None)
+            elif object_type == OBJ_REF_DELTA:
+                base = (None, chunk[position:position + 20])
+                position += 20
+
+            data = self._inflate(chunk[position:], size)
+
+        if base is not None:
+            base_offset, base_sha = base
+            if base_offset is not None:
+                object_type, base_data = self.read(base_offset, find)
+            else:
+                base_object = find(binascii.hexlify(base_sha))
+                if base_object is None:
+                    raise UnsupportedRepository("missing delta base %s" %
+                        binascii.hexlify(base_sha))
+                object_type, base_data = base_object
+            data = _apply_delta(base_data, data)
+
+        result = (object_type, data)
+        if object_type in (OBJ_COMMIT, OBJ_TAG):
+            self.base_cache.put((self, offset), result)
+        return result
+
+
+    def _inflate(self, chunk, size):
+        decompressor = zlib.decompressobj()
+        parts = []
+        length = 0
+        while True:
+            part = decompressor.decompress(chunk)
+            parts.append(part)
+            length += len(part)
+            if length >= size or decompressor.unused_data:
+                break
+            chunk = self.file.read(65536)
+            if not chunk:
+                raise UnsupportedRepository("truncated pack %s" % self.file.name)
+        return "".join(parts)
+
+
+    def close(self):
+        self.file.close()
+
+
+def _delta_size(delta, position):
+    size = 0
+    shift = 0
+    while True:
+        c = ord(delta[position])
+        position += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, position
+
+
+def _apply_delta(base, delta):
+    base_size, position = _delta_size(delta, 0)
+    result_size, position = _delta_size(delta, position)
+    if base_size != len(base):
+        raise UnsupportedRepository("delta does not match its base")
+    parts = []
+    while position < len(delta):
+        op = ord(delta[position])
+        position += 1
+        if op & 0x80:
+            # copy from base
+            offset = 0
+            size = 0
+            for i in range(0, 4):
+                if op & (1 << i):
+                    offset |= ord(delta[position]) << (8 * i)
+                    position += 1
+            for i in range(0, 3):
+                if op & (0x10 << i):
+                    size |= ord(delta[position]) << (8 * i)
+                    position += 1
+            if size == 0:
+                size = 0x10000
+            parts.append(base[offset:offset + size])
+        elif op:
+            # insert from delta
+            parts.append(delta[position:position + op])
+            position += op
+        else:
+            raise UnsupportedRepository("invalid delta")
+    result = "".join(parts)
+    if len(result) != result_size:
+        raise UnsupportedRepository("delta does not match its result")
+    return result
+
+
+def _ident_name(ident):
+    return ident.split(" <", 1)[0].strip()
+
+
+def _ident_time(ident):
+    try:
+        return int(ident.rsplit(">", 1)[1].split()[0])
+    except (IndexError, ValueError):
+        return 0
+
+
+"""
+Returns the commit time, parents and the fields GitTail lists of a commit
+"""
+def _parse_commit(sha, data):
+    header, _, message = data.partition("\n\n")
+    parents = []
+    author = committer = ""
+    commit_time = 0
+    encoding = "utf-8"
+    for line in header.split("\n"):
+        if line[0:7] == "parent ":
+            parents.append(line[7:47])
+        elif line[0:7] == "author ":
+            author = _ident_name(line[7:])
+        elif line[0:10] == "committer ":
+            committer = _ident_name(line[10:])
+            commit_time = _ident_time(line[10:])
+        elif line[0:9] == "encoding ":
+            encoding = line[9:].strip()
+
+    # the subject is the first paragraph of the message on one line
+    subject = []
+    for line in message.lstrip("\n").split("\n"):
+        if not line.strip():
+            break
+        subject.append(line.rstrip())
+    subject = " ".join(subject)
+
+    def decode(value):
+        try:
+            return value.decode(encoding, "replace")
+        except LookupError:
+            return value.decode("utf-8", "replace")
+
+    return commit_time, parents, {
+        'hash': unicode(sha),
+        'committer': decode(committer),
+        'author': decode(author),
+        'commit_time': commit_time,
+        'subject': decode(subject),
+    }
+
+
+class Repository():
+    def __init__(self, git_dir, object_cache, base_cache):
+        self.git_dir = git_dir
+        self.object_cache = object_cache
+        self.base_cache = base_cache
+        self._packs = {}
+        self._packs_mtime = None
+        self._packs_lock = threading.Lock()
+        self._fingerprint = (None, None)
+
+        for name in ("commondir", "objects/info/alternates", "info/grafts"):
+            if os.path.exists(os.path.join(git_dir, name)):
+                raise UnsupportedRepository("%s has %s" % (git_dir, name))
+        f = open(os.path.join(git_dir, "config"))
+        try:
+            config = f.read().lower()
+        finally:
+            f.close()
+        for name in ("objectformat", "refstorage"):
+            if name in config:
+                raise UnsupportedRepository("%s sets %s" % (git_dir, name))
+
+        self.shallow = set()
+        try:
+            f = open(os.path.join(git_dir, "shallow"))
+            try:
+                self.shallow = set(f.read().split())
+            finally:
+                f.close()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+    """
+    Returns the names and object ids of HEAD and all refs, the way
+    git show-ref --head lists them
+    """
+    def refs(self):
+        refs = {}
+        try:
+            f = open(os.path.join(self.git_dir, "packed-refs"))
+            try:
+                for line in f:
+                    if line[0:1] in ("#", "^"):
+                        continue
+                    parts = line.rstrip("\n").split(" ", 1)
+                    if len(parts) == 2:
+                        refs[parts[1]] = parts[0]
+            finally:
+                f.close()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        refs_dir = os.path.join(self.git_dir, "refs")
+        for root, dirs, files in os.walk(refs_dir):
+            for name in files:
+                if name.endswith(".lock"):
+                    continue
+                path = os.path.join(root, name)
+                value = self._read_ref(path)
+                if value is not None:
+                    refs["refs/" + os.path.relpath(path, refs_dir).replace(os.sep, "/")] = value
+
+        for name in refs.keys():
+            if name.startswith("refs/replace/"):
+                raise UnsupportedRepository("%s has replace refs" % self.git_dir)
+            refs[name] = self._resolve(refs[name], refs)
+            if refs[name] is None:
+                del refs[name]
+
+        result = []
+        head = self._read_ref(os.path.join(self.git_dir, "HEAD"))
+        if head is not None:
+            head = self._resolve(head, refs)
+            if head is not None:
+                result.append(("HEAD", head))
+        result.extend(sorted(refs.items()))
+        return result
+
+
+    def _read_ref(self, path):
+        try:
+            f = open(path)
+            try:
+                return f.read().strip()
+            finally:
+                f.close()
+        except IOError, e:
+            if e.errno in (errno.ENOENT, errno.EISDIR):
+                return None
+            raise
+
+
+    def _resolve(self, value, refs):
+        for i in range(0, 5):
+            if value is None or value[0:5] != "ref: ":
+                break
+            value = refs.get(value[5:].strip())
+        if value is None or len(value) != 40:
+            return None
+        return value
+
+
+    """
+    Returns the fingerprint of refs, the same that git show-ref --head | cksum
+    prints
+    """
+    def fingerprint(self, refs):
+        listing = "".join(["%s %s\n" % (sha, name) for name, sha in refs])
+        key = (binascii.crc32(listing), len(listing))
+        if self._fingerprint[0] != key:
+            self._fingerprint = (key, cksum(listing))
+        return self._fingerprint[1]
+
+
+    def _update_packs(self):
+        pack_dir = os.path.join(self.git_dir, "objects", "pack")
+        try:
+            mtime = os.stat(pack_dir).st_mtime
+        except OSError:
+            mtime = None
+        with self._packs_lock:
+            if mtime == self._packs_mtime:
+                return
+            packs = {}
+            if mtime is not None:
+                for name in os.listdir(pack_dir):
+                    if not name.endswith(".idx"):
+                        continue
+                    path = os.path.join(pack_dir, name[:-4])
+                    if self._packs.has_key(path):
+                        packs[path] = self._packs.pop(path)
+                    elif os.path.exists(path + ".pack"):
+                        packs[path] = Pack(path, self.base_cache)
+            for pack in self._packs.values():
+                pack.close()
+            self._packs = packs
+            self._packs_mtime = mtime
+
+
+    """
+    Returns the type and data of an object, or None if it does not exist
+    """
+    def read(self, sha):
+        path = os.path.join(self.git_dir, "objects", sha[0:2], sha[2:])
+        try:
+            f = open(path, "rb")
+            try:
+                data = zlib.decompress(f.read())
+            finally:
+                f.close()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        except zlib.error:
+            raise UnsupportedRepository("corrupt object %s" % sha)
+        else:
+            header, _, data = data.partition("\0")
+            object_type = OBJECT_TYPES.get(header.split(" ")[0])
+            if object_type is None:
+                raise UnsupportedRepository("unknown object type %s" % header)
+            return object_type, data
+
+        try:
+            binary_sha = binascii.unhexlify(sha)
+        except TypeError:
+            return None
+        for i in range(0, 2):
+            for pack in self._packs.values():
+                offset = pack.index.find(binary_sha)
+                if offset is not None:
+                    return pack.read(offset, self.read)
+            # the object may have been packed since the packs were listed
+            mtime = self._packs_mtime
+            self._update_packs()
+            if mtime == self._packs_mtime:
+                break
+        return None
+
+
+    """
+    Returns the commit time, parents and fields of a commit, or None if sha
+    is missing or is not a commit. Annotated tags are peeled.
+    """
+    def commit(self, sha):
+        commit = self.object_cache.get(sha)
+        if commit is None:
+            commit = self._read_commit(sha)
+            if commit is None:
+                return None
+            self.object_cache.put(sha, commit)
+        if commit[2]['hash'] in self.shallow:
+            # the parents of shallow commits are not in the repository
+            commit = (commit[0], [], commit[2])
+        return commit
+
+
+    def _read_commit(self, sha):
+        for i in range(0, 10):
+            obj = self.read(sha)
+            if obj is None:
+                return None
+            object_type, data = obj
+            if object_type != OBJ_TAG:
+                break
+            if data[0:7] != "object ":
+                return None
+            sha = data[7:47]
+        if object_type != OBJ_COMMIT:
+            return None
+        return _parse_commit(sha, data)
+
+
+    """
+    Returns the fields of the commits reachable from refs, newest first, the
+    way git log --all lists them. With exclude, commits reachable from the
+    commits in exclude are left out (missing ones are ignored), otherwise
+    commits older than since are. The dicts of fields are those kept in the
+    object cache and must not be modified.
+    """
+    def log(self, refs, since=None, exclude=None):
+        self._update_packs()
+        queue = []
+        counter = [0]
+        commits = {}
+        uninteresting = set()
+        # commits in the queue that may still be listed
+        pending = set()
+
+        def push(sha):
+            commit = self.commit(sha)
+            if commit is None:
+                return None
+            sha = commit[2]['hash']
+            if not commits.has_key(sha):
+                commits[sha] = commit
+                counter[0] += 1
+                heapq.heappush(queue, (-commit[0], counter[0], sha))
+                if sha not in uninteresting:
+                    pending.add(sha)
+            return sha
+
+        def mark_uninteresting(sha):
+            stack = [sha]
+            while stack:
+                sha = stack.pop()
+                if sha in uninteresting:
+                    continue
+                uninteresting.add(sha)
+                pending.discard(sha)
+                if commits.has_key(sha):
+                    stack.extend([p for p in commits[sha][1] if commits.has_key(p)])
+
+        for sha in exclude or []:
+            commit = self.commit(sha)
+            if commit is not None:
+                mark_uninteresting(commit[2]['hash'])
+                push(commit[2]['hash'])
+        # git log --all starts from HEAD after the refs
+        for name, sha in sorted(refs, key=lambda ref: ref[0] == "HEAD"):
+            push(sha)
+
+        listed = []
+        while queue and (not exclude or pending):
+            commit_time, i, sha = heapq.heappop(queue)
+            pending.discard(sha)
+            parents = commits[sha][1]
+            if sha in uninteresting:
+                for parent in parents:
+                    mark_uninteresting(parent)
+                    push(parent)
+                continue
+            if since is not None and commits[sha][0] < since:
+                continue
+            listed.append(sha)
+            for parent in parents:
+                if push(parent) is None and not commits.has_key(parent):
+                    raise UnsupportedRepository("missing commit %s" % parent)
+
+        return [commits[listed_sha][2] for listed_sha in listed
+            if listed_sha not in uninteresting]
+
+
+    def close(self):
+        with self._packs_lock:
+            for pack in self._packs.values():
+                pack.close()
+            self._packs = {}
+            self._packs_mtime = None
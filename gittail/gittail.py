@@ -32,28 +32,391 @@ A command-line utility written in Python that watches a set of Git repositories
 and sends notifications via Growl or Libnotify when new commits are spotted.
 """
 
+import binascii
+import collections
+import getpass
+import hashlib
 import os
+import pipes
+import random
+import signal
+import socket
+import sqlite3
 import sys
 import subprocess
+import tempfile
+import threading
 import time
+import Queue
+
+from commits import Commit, intern_string
+from metrics import PollMetrics, append_json_line
+from gitobjects import ObjectCache, Repository, UnsupportedRepository, list_repos
 
 import codecs
 sys.stdout = codecs.getwriter('utf8')(sys.stdout)
 sys.stderr = codecs.getwriter('utf8')(sys.stderr)
 
-# Make bundled Git submodules includable
-lib_path = "%s/../lib" % os.path.dirname(__file__)
-if os.path.isdir(lib_path):
-    for path in os.listdir(lib_path):
-        submodule_path = "%s/%s" % (lib_path, path)
-        if os.path.isdir(submodule_path):
-            sys.path.append(submodule_path)
+
+"""
+Makes bundled Git submodules includable. Called before importing optional
+modules, which may be bundled.
+"""
+_bundled_libraries_added = False
+def add_bundled_libraries():
+    global _bundled_libraries_added
+    if _bundled_libraries_added:
+        return
+    _bundled_libraries_added = True
+    lib_path = "%s/../lib" % os.path.dirname(os.path.abspath(__file__))
+    if os.path.isdir(lib_path):
+        for path in os.listdir(lib_path):
+            submodule_path = "%s/%s" % (lib_path, path)
+            if os.path.isdir(submodule_path):
+                sys.path.append(submodule_path)
+
+
+"""
+Returns value as a utf-8 encoded str. Repo names are unicode, and would
+otherwise be encoded with the encoding of the locale when put into a command
+line or a path, which fails e.g. under the C locale of cron.
+"""
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+"""
+Set of the hashes of previously seen commits
+
+Hashes are kept in binary form, and are forgotten max_age seconds after they
+were last seen, or earlier if more than max_size hashes are kept.
+"""
+class SeenCommits():
+    def __init__(self, max_age, max_size):
+        self.max_age = max_age
+        self.max_size = max_size
+        self._last_seen = {}
+        self._unsaved = {}
+        # (time, hash) in the order hashes were seen. Entries of hashes that
+        # have been seen again since are skipped on eviction.
+        self._queue = collections.deque()
+
+
+    def __contains__(self, commit_hash):
+        return self._last_seen.has_key(binascii.unhexlify(commit_hash))
+
+
+    def __len__(self):
+        return len(self._last_seen)
+
+
+    def add(self, commit_hash, now=None):
+        if now is None:
+            now = int(time.time())
+        key = binascii.unhexlify(commit_hash)
+        if self._last_seen.get(key) != now:
+            self._last_seen[key] = now
+            self._unsaved[key] = now
+            self._queue.append((now, key))
+        self.evict(now)
+
+
+    """
+    Adds a binary hash seen at the given time, as returned by pop_unsaved()
+    """
+    def load(self, key, seen):
+        self._last_seen[key] = seen
+        self._queue.append((seen, key))
+
+
+    """
+    Returns the binary hashes seen since the previous call, with the
+    time they were seen
+    """
+    def pop_unsaved(self):
+        unsaved = self._unsaved
+        self._unsaved = {}
+        return unsaved
+
+
+    def evict(self, now=None):
+        if now is None:
+            now = int(time.time())
+        while self._queue:
+            seen, key = self._queue[0]
+            if self._last_seen.get(key) != seen:
+                self._queue.popleft()
+            elif seen < now - self.max_age or len(self._last_seen) > self.max_size:
+                self._queue.popleft()
+                del self._last_seen[key]
+            else:
+                break
+
+
+"""
+SQLite database holding the state that allows GitTail to continue where it
+left off after a restart: the seen commits and the ref fingerprints and
+cursors of every repo.
+"""
+class StateStore():
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.lock = threading.Lock()
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY, value TEXT)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS seen_commits (
+                hash BLOB PRIMARY KEY, last_seen INTEGER)""")
+            self.db.execute("""CREATE INDEX IF NOT EXISTS seen_commits_last_seen
+                ON seen_commits (last_seen)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS repos (
+                spec TEXT, repo TEXT, fingerprint TEXT, tips TEXT,
+                PRIMARY KEY (spec, repo))""")
+
+
+    def get_meta(self, name, default=None):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+
+    """
+    Returns (name, value) of every meta value whose name starts with prefix
+    """
+    def meta_items(self, prefix):
+        with self.lock:
+            return self.db.execute(
+                "SELECT name, value FROM meta WHERE substr(name, 1, ?) = ?",
+                (len(prefix), prefix)).fetchall()
+
+
+    """
+    Loads the stored state into a SeenCommits instance and the ref
+    fingerprint and cursor dicts of GitTail
+    """
+    def load(self, commits, ref_fingerprints, ref_tips):
+        with self.lock:
+            for key, seen in self.db.execute("""SELECT hash, last_seen
+                    FROM seen_commits ORDER BY last_seen"""):
+                commits.load(str(key), seen)
+            commits.evict()
+
+            for spec, repo, fingerprint, tips in self.db.execute(
+                    "SELECT spec, repo, fingerprint, tips FROM repos"):
+                repo = repo.decode('utf-8')
+                if fingerprint is not None:
+                    ref_fingerprints.setdefault(spec, {})[repo] = fingerprint
+                if tips is not None:
+                    ref_tips.setdefault(spec, {})[repo] = tips.split(" ")
+
+
+    """
+    Writes everything that has changed since the previous save in a single
+    transaction. specs lists the repo specs whose fingerprints and cursors
+    have changed.
+    """
+    def save(self, commits, ref_fingerprints, ref_tips, specs, meta={}):
+        with self.lock:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO seen_commits VALUES (?, ?)",
+                    [(sqlite3.Binary(key), seen) for key, seen
+                     in commits.pop_unsaved().iteritems()])
+                self.db.execute("DELETE FROM seen_commits WHERE last_seen < ?",
+                    (int(time.time()) - commits.max_age,))
+                self.db.execute("""DELETE FROM seen_commits WHERE hash IN (
+                    SELECT hash FROM seen_commits ORDER BY last_seen DESC
+                    LIMIT -1 OFFSET ?)""", (commits.max_size,))
+
+                for spec in specs:
+                    self.db.execute("DELETE FROM repos WHERE spec = ?", (spec,))
+                    fingerprints = ref_fingerprints.get(spec, {})
+                    tips = ref_tips.get(spec, {})
+                    rows = []
+                    for repo in set(fingerprints.keys()) | set(tips.keys()):
+                        repo_tips = tips.get(repo)
+                        if repo_tips is not None:
+                            repo_tips = " ".join(repo_tips)
+                        rows.append((spec, repo.encode('utf-8'),
+                            fingerprints.get(repo), repo_tips))
+                    self.db.executemany(
+                        "INSERT INTO repos VALUES (?, ?, ?, ?)", rows)
+
+                for name in meta:
+                    self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                        (name, meta[name]))
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+"""
+Decides when each repo spec is polled next. The interval of a repo spec
+shrinks towards min_interval while new commits keep turning up, and grows
+towards max_interval while it stays idle. Failing repo specs are retried
+with exponential backoff. Every interval is randomly stretched or shrunk by
+up to jitter (a fraction), so that repo specs drift apart over time.
+"""
+class PollScheduler():
+    def __init__(self, interval, min_interval, max_interval, jitter=0.1):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        # spec key -> {"interval", "due", "failures"}
+        self._specs = {}
+
+
+    def is_due(self, key, now=None):
+        if now is None:
+            now = time.time()
+        if not self._specs.has_key(key):
+            return True
+        return self._specs[key]["due"] <= now
+
+
+    """
+    Returns the time when the first repo spec is due, or None if
+    no repo spec has been scheduled
+    """
+    def next_due(self):
+        if not self._specs:
+            return None
+        return min([spec["due"] for spec in self._specs.values()])
+
+
+    def update(self, key, new_commits, failed, now=None):
+        if now is None:
+            now = time.time()
+        spec = self._specs.setdefault(key,
+            {"interval": self.interval, "due": now, "failures": 0})
+
+        if failed:
+            spec["failures"] += 1
+            delay = min(self.max_interval,
+                self.interval * 2 ** (spec["failures"] - 1))
+        else:
+            spec["failures"] = 0
+            if new_commits > 0:
+                spec["interval"] = max(self.min_interval, spec["interval"] / 2.0)
+            else:
+                spec["interval"] = min(self.max_interval, spec["interval"] * 1.5)
+            delay = spec["interval"]
+
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        spec["due"] = now + delay
+        return delay
+
+
+    """
+    Makes a repo spec due no earlier than until, e.g. while its host is
+    skipped
+    """
+    def postpone(self, key, until):
+        spec = self._specs.setdefault(key,
+            {"interval": self.interval, "due": until, "failures": 0})
+        spec["due"] = max(spec["due"], until)
+
+
+"""
+Keeps track of failing hosts. After max_failures consecutive failed polls
+a host is skipped ("open") for cooldown seconds, after which it is tried
+again ("half-open"). A successful poll resets it ("closed").
+"""
+class CircuitBreaker():
+    def __init__(self, max_failures, cooldown):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        # host -> [consecutive failures, time of last failure]
+        self._hosts = {}
+
+
+    def state(self, host, now=None):
+        if now is None:
+            now = time.time()
+        failures, failed_at = self._hosts.get(host, (0, 0))
+        if failures < self.max_failures:
+            return "closed"
+        if now - failed_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+
+    def allow(self, host, now=None):
+        return self.state(host, now) != "open"
+
+
+    """
+    Returns the time when an open host is tried again
+    """
+    def retry_time(self, host):
+        failures, failed_at = self._hosts.get(host, (0, 0))
+        return failed_at + self.cooldown
+
+
+    def record(self, host, failed, now=None):
+        if now is None:
+            now = time.time()
+        if not failed:
+            self._hosts.pop(host, None)
+            return
+        failures, failed_at = self._hosts.get(host, (0, 0))
+        self._hosts[host] = (failures + 1, now)
+
+
+    """
+    Returns a one line description of the state of a host
+    """
+    def describe(self, host, now=None):
+        if now is None:
+            now = time.time()
+        state = self.state(host, now)
+        failures, failed_at = self._hosts.get(host, (0, 0))
+        if state == "open":
+            return "%s open (%d failures, retry in %d seconds)" % (
+                host, failures, self.cooldown - (now - failed_at))
+        if failures:
+            return "%s %s (%d failures)" % (host, state, failures)
+        return "%s %s" % (host, state)
 
 
 class GitTail():
     def __init__(self, **kwargs):
         self.first_run = True
-        self.commits = {}
+        self._template_cache = {}
+        self._job_stats = threading.local()
+        self.metrics = PollMetrics()
+        self.ref_fingerprints = {}
+        self.ref_tips = {}
+        self.helper_cursors = {}
+        self._remote_helper_source = None
+        self._changed_specs = set()
+        self.discovered_repos = {}
+        self.discovery = {}
+        # spec keys to poll when working for a coordinator, see shard.py
+        self.shard = None
+        self.publish = None
+        # set by run_profiled(), see profiling.py
+        self.profiler = None
+        # set by --record, see recording.py
+        self.recorder = None
+        self.watcher = None
+        self._load_lock = threading.Lock()
+        self._notifiers_loaded = False
+        self._templates_loaded = False
+        # path -> Repository, for reading local repos without git
+        self._local_repositories = {}
+        self._ssh_sessions = {}
+        self._ssh_sessions_lock = threading.Lock()
 
         # Properties to extract when using git log
         # man git-log for details:
@@ -61,10 +424,13 @@ class GitTail():
             'hash': '%H',
             'committer': '%cn',
             'author': '%an',
-            'time': '%cr',
+            'commit_time': '%ct',
             'subject': '%s',
         }
-        self._git_log_commit_delimiter = '|'
+        # Fields are separated by NUL, which unlike any printable character
+        # cannot appear in a commit subject or name
+        self._git_log_commit_delimiter = '\x00'
+        self._git_log_format_delimiter = '%x00'
 
         try:
             self._config_value = kwargs["config"]
@@ -72,66 +438,152 @@ class GitTail():
             self._config_value = {}
 
         self.verbosity = self._config("verbosity", 0)
+
+        self.commits = SeenCommits(
+            self._config("seen_commits_max_age", 2 * 86400),
+            self._config("seen_commits_max_size", 100000))
+
+        self.circuit_breaker = CircuitBreaker(
+            self._config("circuit_breaker_failures", 3),
+            self._config("circuit_breaker_cooldown", 300))
+
+        self._commit_cache = ObjectCache(self._config("native_reader_cache_size", 10000))
+        self._delta_base_cache = ObjectCache(256)
+
+        if self._config("metrics_port", False):
+            self.metrics.serve(self._config("metrics_port"))
+
+        self.pushes = None
+        self.push_server = None
+        if self._config("push_address", False):
+            from ingest import PushServer
+            self.pushes = Queue.Queue()
+            self.push_server = PushServer(self._config("push_address"),
+                self.pushes, self.log)
+            self.push_server.start()
+
+        self.dispatcher = None
+        if self._config("async_notifications", False):
+            from dispatcher import NotificationDispatcher
+            self.dispatcher = NotificationDispatcher(self.notify, self.log,
+                self._config("notify_queue_size", 100),
+                self._config("notify_coalesce_window", 2),
+                self._config("notify_rate_limit", 10))
+
+        self.scheduler = None
+        if self._config("adaptive_polling", False):
+            interval = self._config("poll_interval", 60)
+            self.scheduler = PollScheduler(interval,
+                self._config("poll_interval_min", interval / 4.0),
+                self._config("poll_interval_max", interval * 10),
+                self._config("poll_jitter", 0.1))
+
+        self.state = None
+        state_file = self._config("state_file", False)
+        if state_file:
+            self.state = StateStore(os.path.expanduser(state_file))
+            self.state.load(self.commits, self.ref_fingerprints, self.ref_tips)
+            for name, value in self.state.meta_items("helper_cursor:"):
+                self.helper_cursors[name[len("helper_cursor:"):]] = value
+            if self.state.get_meta("first_run_done"):
+                self.log("Continuing from state in %s" % state_file, 1)
+                self.first_run = False
         if self._config("quiet", 0) == 1: self.verbosity = -1
 
-        if self._config("use_libnotify", -1) in [True, -1]:
-            try:
-                from gi.repository import Notify as libnotify
-                self.libnotify = libnotify
-                self.libnotify.init("GitTail")
-            except ImportError, e:
-                msg = "Failed to import gi.repository.Notify"
-                if self._config("use_libnotify", -1) == True:
-                    raise ImportError(msg)
-                self.log(msg)
-                self._config_value["use_libnotify"] = False
-
-        if self._config("use_growl", -1) in [True, -1]:
-            GrowlNotifier = None
+        if self._config("watch_local_repos", -1) in [True, -1] and \
+                self._config("local_repos", []):
             try:
-                from growl import Growl
-                GrowlNotifier = Growl.GrowlNotifier
-            except ImportError, e:
+                from watcher import RepoWatcher
+                self.watcher = RepoWatcher(self._config("watch_debounce", 0.5))
+            except (ImportError, OSError), e:
+                msg = "Failed to start inotify watcher: %s" % e
+                if self._config("watch_local_repos", -1) == True:
+                    raise
+                self.log(msg, 1)
+                self._config_value["watch_local_repos"] = False
+
+
+    """
+    Loads the notification backends enabled in the configuration. Called
+    when the first notification is sent rather than on initialization, so
+    that a GitTail that does not notify does not wait for them.
+    """
+    def _load_notifiers(self):
+        with self._load_lock:
+            if self._notifiers_loaded:
+                return
+            self._notifiers_loaded = True
+            add_bundled_libraries()
+
+            if self._config("use_libnotify", -1) in [True, -1]:
                 try:
-                    import gntp.notifier
-                    GrowlNotifier = gntp.notifier.GrowlNotifier
+                    from gi.repository import Notify as libnotify
+                    self.libnotify = libnotify
+                    self.libnotify.init("GitTail")
                 except ImportError, e:
-                    msg = "Failed to load Growl bindings"
-                    if self._config("use_growl", -1) == True:
+                    msg = "Failed to import gi.repository.Notify"
+                    if self._config("use_libnotify", -1) == True:
                         raise ImportError(msg)
                     self.log(msg)
-                    self._config_value["use_growl"] = False
+                    self._config_value["use_libnotify"] = False
 
-            if GrowlNotifier != None:
-                self.growler = GrowlNotifier(
-                    applicationName='GitTail',
-                    notifications=['commit']
-                )
+            if self._config("use_growl", -1) in [True, -1]:
+                GrowlNotifier = None
                 try:
-                    self.growler.register()
-                except gntp.errors.NetworkError, e:
-                    self.log("gntp.errors.NetworkError: Growl not started?")
-                    if self._config("use_growl", -1) == True:
-                        raise e
+                    from growl import Growl
+                    GrowlNotifier = Growl.GrowlNotifier
+                except ImportError, e:
+                    try:
+                        import gntp.notifier
+                        GrowlNotifier = gntp.notifier.GrowlNotifier
+                    except ImportError, e:
+                        msg = "Failed to load Growl bindings"
+                        if self._config("use_growl", -1) == True:
+                            raise ImportError(msg)
+                        self.log(msg)
+                        self._config_value["use_growl"] = False
+
+                if GrowlNotifier != None:
+                    self.growler = GrowlNotifier(
+                        applicationName='GitTail',
+                        notifications=['commit']
+                    )
+                    try:
+                        self.growler.register()
+                    except gntp.errors.NetworkError, e:
+                        self.log("gntp.errors.NetworkError: Growl not started?")
+                        if self._config("use_growl", -1) == True:
+                            raise e
 
-        if self._config("use_templates", True):
-            try:
-                from jinja2 import Environment, FileSystemLoader
-                import jinja2.exceptions as jinja2_exceptions
-                self.jinja2_exceptions = jinja2_exceptions
-                self.jinja2_default_templates = Environment(
-                    loader=FileSystemLoader(
-                        "%s/templates/jinja2" % os.path.dirname(__file__)),
-                    trim_blocks=True)
-                custom_template_path = self._config("template_path", False)
-                if custom_template_path:
-                    self.jinja2_custom_templates = Environment(
+
+    """
+    Creates the template environments when the first message is rendered
+    """
+    def _load_templates(self):
+        with self._load_lock:
+            if self._templates_loaded:
+                return
+            self._templates_loaded = True
+            add_bundled_libraries()
+
+            if self._config("use_templates", True):
+                try:
+                    from jinja2 import Environment, FileSystemLoader
+                    import jinja2.exceptions as jinja2_exceptions
+                    self.jinja2_exceptions = jinja2_exceptions
+                    self.jinja2_default_templates = Environment(
                         loader=FileSystemLoader(
-                            "%s/jinja2" % custom_template_path),
+                            "%s/templates/jinja2" % os.path.dirname(__file__)),
                         trim_blocks=True)
-            except ImportError:
-                self.log("Failed to import jinja2 - using default messages")
-                self._config_value["use_templates"] = False
+                    custom_template_path = self._config("template_path", False)
+                    if custom_template_path:
+                        self.jinja2_custom_templates = Environment(
+                            loader=FileSystemLoader(
+                                "%s/jinja2" % custom_template_path),
+                            trim_blocks=True)
+                except ImportError:
+                    self.log("Failed to import jinja2 - using default messages")
+                    self._config_value["use_templates"] = False
 
 
     """
@@ -149,16 +601,42 @@ class GitTail():
 
     """
     Format and send messages to console and to the supported notification
-    mechanisms
+    mechanisms. allow can be used to leave out some of them.
     """
-    def notify(self, message_type, data):
-        console_message = self._render_message(
-            message_type, data, 'console')
-        self.log(console_message['message'])
+    def notify(self, message_type, data, allow=None):
+        start = time.time()
+        try:
+            self._notify(message_type, data, allow)
+        finally:
+            self.metrics.record_notify(message_type, time.time() - start)
+
 
+    def _notify(self, message_type, data, allow):
+        previous = self._label_activity("notify %s" % message_type)
+        try:
+            self._send_notification(message_type, data, allow)
+        finally:
+            self._label_activity(previous)
+
+
+    def _send_notification(self, message_type, data, allow):
+        self._load_notifiers()
+        targets = []
+        if self.verbosity >= 0:
+            targets.append('console')
         if self._config("use_growl", True):
-            growl_message = self._render_message(
-                message_type, data, 'growl')
+            targets.append('growl')
+        if self._config("use_libnotify", True):
+            targets.append('libnotify')
+        if allow is not None:
+            targets = [target for target in targets if allow(target)]
+        messages = self._render_messages(message_type, data, targets)
+
+        if messages.has_key('console'):
+            self.log(messages['console']['message'])
+
+        if messages.has_key('growl'):
+            growl_message = messages['growl']
             title = growl_message['title']
             text = growl_message['text']
             icon = None
@@ -179,9 +657,9 @@ class GitTail():
                 if self._config("use_growl", -1) == True:
                     raise e
 
-        if self._config("use_libnotify", True):
+        if messages.has_key('libnotify'):
             try:
-                note_config = self._config('libnotify_note')
+                note_config = dict(self._config('libnotify_note'))
             except KeyError:
                 note_config = {}
             try:
@@ -190,8 +668,7 @@ class GitTail():
             except KeyError:
                 pass
 
-            libnotify_message = self._render_message(
-                message_type, data, 'libnotify')
+            libnotify_message = messages['libnotify']
             Note=self.libnotify.Notification.new(
                 libnotify_message['summary'],
                 libnotify_message['body'],
@@ -217,43 +694,447 @@ class GitTail():
 
 
     def poll(self):
-        new_commits = []
-
         ssh_hosts = self._config("ssh_hosts", [])
-        for host in ssh_hosts:
-            self.log("Checking SSH host '%s'" % host["host"], 1)
-            for repo in host["repos"]:
-                self.log("Checking path '%s' for pattern '%s'" % (repo["base_path"], repo["pattern"]), 2)
-                result = self.poll_ssh_host(host, repo)
-                for commit in result:
-                    new_commits.append(commit)
-
         local_repos = self._config("local_repos", [])
-        for repo in local_repos:
-            self.log("Checking local path '%s' for pattern '%s'" % (repo["base_path"], repo["pattern"]), 2)
-            result = self.poll_local_repo(repo)
-            for commit in result:
-                new_commits.append(commit)
 
         if len(ssh_hosts) == 0 and len(local_repos) == 0:
             self.log("No repos configured")
             return False
 
+        self._poll(self._poll_jobs(ssh_hosts, local_repos))
+        self._watch_local_repos()
+        return True
+
+
+    """
+    Polls only the given local repos, as reported by the repo watcher.
+    changed is a set of (local_repos index, repo name) pairs.
+    """
+    def poll_local_changes(self, changed):
+        local_repos = self._config("local_repos", [])
+        repo_names = {}
+        for index, name in changed:
+            repo_names.setdefault(index, []).append(name)
+
+        jobs = []
+        for index in sorted(repo_names.keys()):
+            repo = local_repos[index]
+            names = sorted(repo_names[index])
+            self.log("Changes in local repositories %s" % ", ".join(names), 1)
+            jobs.append({
+                "host": "localhost",
+                "specs": [{"key": self._repo_spec_key(repo),
+                    "context": {"repo": repo, "repo_names": names}}],
+                "fetch": lambda repo=repo, names=names: [self._fetch_local_repo(repo, names)],
+            })
+        self._poll(jobs)
+
+
+    """
+    Fetches only the commits of the given pushes, see ingest.py
+    """
+    def poll_pushes(self, pushes):
+        # (repo spec key, repo name) -> (host, repo spec, repo name, updates)
+        updates = collections.OrderedDict()
+        for push in pushes:
+            match = self._match_push(push)
+            if match is None:
+                self.log("Ignoring push to unknown repository %s" % push["repo"])
+                continue
+            host, repo, name = match
+            key = (self._repo_spec_key(repo, host), name)
+            if not updates.has_key(key):
+                updates[key] = (host, repo, name, [])
+            updates[key][3].append(push)
+
+        jobs = []
+        for key, name in updates:
+            host, repo, name, repo_updates = updates[(key, name)]
+            self.log("Push to %s in %s" % (name, key), 1)
+            if host is None:
+                fetch = lambda repo=repo, name=name, repo_updates=repo_updates: \
+                    [self._fetch_local_push(repo, name, repo_updates)]
+            else:
+                fetch = lambda host=host, repo=repo, name=name, repo_updates=repo_updates: \
+                    [self._fetch_ssh_push(host, repo, name, repo_updates)]
+            jobs.append({
+                "host": (host or {"host": "localhost"})["host"],
+                "specs": [{"key": key, "context": {"host": host, "repo": repo,
+                    "repo_names": [name]}}],
+                "fetch": fetch,
+            })
+        if jobs:
+            self._poll(jobs)
+
+
+    """
+    Returns the SSH host (None for local repos), repo spec and repo name
+    a push was made to, or None if no repo spec covers it. Only repos found
+    by polling are matched; new ones are left to the next poll.
+    """
+    def _match_push(self, push):
+        if push["host"] in (None, "localhost"):
+            candidates = [(None, repo) for repo in self._config("local_repos", [])]
+        else:
+            candidates = []
+            for host in self._config("ssh_hosts", []):
+                if host["host"] == push["host"]:
+                    candidates.extend([(host, repo) for repo in host["repos"]])
+
+        path = push["repo"].rstrip("/")
+        if path.endswith("/.git"):
+            path = path[:-5]
+        for host, repo in candidates:
+            name = path
+            base_path = repo.get("base_path", "")
+            if host is None:
+                base_path = os.path.expanduser(base_path)
+            if name.startswith("/"):
+                if not name.startswith(base_path.rstrip("/") + "/"):
+                    continue
+                name = name[len(base_path.rstrip("/")) + 1:]
+            if name in self.discovered_repos.get(self._repo_spec_key(repo, host), []):
+                return host, repo, name
+        return None
+
+
+    """
+    Returns the new and the old tips of the refs updated by a push, leaving
+    out deleted refs, and whether the push created refs
+    """
+    def _push_tips(self, updates):
+        null_sha = "0" * 40
+        new_tips = [(update["ref"], update["new"]) for update in updates
+            if update["new"] != null_sha]
+        old_tips = [update["old"] for update in updates if update["old"] != null_sha]
+        created = len([update for update in updates if update["old"] == null_sha]) > 0
+        return new_tips, old_tips, created
+
+
+    """
+    Returns a command listing the commits added by a push: those reachable
+    from the new tips but not from the old ones. Created refs have no old
+    tip, so the commits of the refs that the push did not update are left
+    out as well. HEAD follows an updated branch, and counts as updated.
+    """
+    def _push_log_command(self, repo, name, updates):
+        new_tips, old_tips, created = self._push_tips(updates)
+        exclude = old_tips
+        if created:
+            exclude = exclude + ["--exclude=%s" % update["ref"]
+                for update in updates] + ["--exclude=HEAD", "--all"]
+        return self._cursor_log_command(repo, {name: exclude},
+            {name: [sha for ref, sha in new_tips]})
+
+
+    def _fetch_ssh_push(self, host, repo, name, updates):
+        if not self._push_tips(updates)[0]:
+            return [('repo', name)]
+        self._ensure_ssh_session(host)
+        return self._run_ssh_command(host, self._push_log_command(repo, name, updates))
+
+
+    def _fetch_local_push(self, repo, name, updates):
+        new_tips, old_tips, created = self._push_tips(updates)
+        if not new_tips:
+            return [('repo', name)]
+        if self._config("native_local_reader", True):
+            try:
+                path = os.path.join(_utf8(os.path.expanduser(repo.get("base_path", "."))),
+                    _utf8(name))
+                repository = self._local_repository(path)
+                exclude = old_tips
+                if created:
+                    updated = set([update["ref"] for update in updates])
+                    exclude = exclude + [sha for ref, sha in repository.refs()
+                        if ref not in updated and ref != "HEAD"]
+                return [('repo', name)] + [('commit', Commit(**fields))
+                    for fields in repository.log(new_tips, exclude=exclude)]
+            except (UnsupportedRepository, EnvironmentError), e:
+                self.log("Using git for repository %s: %s" % (name, e), 2)
+        return self._run_local_command(self._push_log_command(repo, name, updates))
+
+
+    def _poll(self, jobs):
+        if self.profiler is None:
+            return self._poll_cycle(jobs)
+        self.profiler.start()
+        previous = self._label_activity("poll")
+        try:
+            self._poll_cycle(jobs)
+        finally:
+            self._label_activity(previous)
+            self.profiler.stop()
+
+
+    def _poll_cycle(self, jobs):
+        new_commits = []
+        cycle_start = time.time()
+
+        failed_hosts = {}
+        job_results = self._run_poll_jobs(jobs)
+        if self.recorder is not None:
+            self.recorder.record(cycle_start, job_results)
+        for job, results in job_results:
+            for spec, result in zip(job["specs"], results):
+                parse_start = time.time()
+                self._label_activity("parse %s" % spec["key"])
+                commits = self._parse_git_log_result(result, **spec["context"])
+                self._label_activity("poll")
+                parsed = 0
+                if result is not None:
+                    parsed = len([record for record in result if record[0] == 'commit'])
+                self.metrics.record_job(job["host"], spec["key"],
+                    job["stats"]["seconds"], time.time() - parse_start,
+                    job["stats"]["bytes"].get(spec["key"], 0), parsed,
+                    len(commits), result is None)
+                # polls of a few repos, for local changes and pushes, say
+                # nothing about how often the whole repo spec changes or
+                # whether the host is still reachable for it
+                if spec["context"].get("repo_names") is None:
+                    if self.scheduler is not None:
+                        self.scheduler.update(spec["key"], len(commits), result is None)
+                    failed_hosts[job["host"]] = failed_hosts.get(job["host"], False) \
+                        or result is None
+                for commit in commits:
+                    new_commits.append(commit)
+
+        for host in sorted(failed_hosts.keys()):
+            self.circuit_breaker.record(host, failed_hosts[host])
+            self.log("Host %s" % self.circuit_breaker.describe(host), 1)
+
+        self._notify_new_commits(new_commits)
+        self.save_state()
+        self._export_metrics(time.time() - cycle_start)
+
+
+    """
+    Logs a summary of the poll cycle and writes the metrics files
+    """
+    def _export_metrics(self, seconds):
+        cycle = self.metrics.record_cycle(seconds)
+        self.log("Poll cycle took %.3f seconds: %d repo specs, %d bytes, "
+            "%d commits, %d new, %d errors" % (cycle["seconds"], cycle["specs"],
+            cycle["bytes"], cycle["commits_parsed"], cycle["new_commits"],
+            cycle["errors"]), 1)
+        for job in cycle["jobs"]:
+            self.log("Polled %s in %.3f seconds: %d bytes, %d commits, %d new%s" % (
+                job["spec"], job["seconds"], job["bytes"], job["commits_parsed"],
+                job["new_commits"], ("", ", failed")[job["failed"]]), 2)
+
+        metrics_file = self._config("metrics_file", False)
+        if metrics_file:
+            self.metrics.write_prometheus(os.path.expanduser(metrics_file))
+        metrics_jsonl = self._config("metrics_jsonl", False)
+        if metrics_jsonl:
+            append_json_line(os.path.expanduser(metrics_jsonl), cycle)
+
+
+    """
+    Runs the fetch function of a job, recording how long it took and how
+    many bytes of output were read for each of its repo specs in
+    job["stats"]
+    """
+    def _run_job(self, job):
+        job["stats"] = {"seconds": 0.0, "bytes": {}, "spec": job["specs"][0]["key"]}
+        self._job_stats.current = job["stats"]
+        previous = self._label_activity("fetch %s" % job["stats"]["spec"])
+        start = time.time()
+        try:
+            return job["fetch"]()
+        finally:
+            job["stats"]["seconds"] = time.time() - start
+            self._job_stats.current = None
+            self._label_activity(previous)
+
+
+    """
+    Labels what the current thread works on in the samples of the profiler,
+    if profiling. Returns the previous label.
+    """
+    def _label_activity(self, label):
+        if self.profiler is None:
+            return None
+        return self.profiler.label(label)
+
+
+    """
+    Sends the notifications for the new commits found by a poll,
+    either individually or as a digest, or hands them to the publish
+    function if one is set
+    """
+    def _notify_new_commits(self, new_commits):
+        if self.publish is not None:
+            self.publish(new_commits, self.first_run)
+            self.first_run = False
+            return
+
+        if self.dispatcher is not None:
+            notify = self.dispatcher.add
+        else:
+            notify = self.notify
+
         if self.first_run:
-            self.notify('commit_digest_first_run', {'commits': self.commits.values()})
+            notify('commit_digest_first_run', {'commits': new_commits})
             self.first_run = False
-            return True
+            return
 
         if self._config("digest_threshold", 10) != 0:
             if len(new_commits) >= self._config("digest_threshold", 10):
-                self.notify('commit_digest', {'commits': new_commits})
-                return True
+                notify('commit_digest', {'commits': new_commits})
+                return
 
-        if len(new_commits) > 0:
+        if self.dispatcher is not None:
+            self.dispatcher.add_commits(new_commits)
+        elif len(new_commits) > 0:
             for commit in new_commits:
                 self.notify('commit', {'commit': commit})
 
-        return True
+
+    """
+    Writes the changes since the previous poll to the state file, if one is
+    configured
+    """
+    def save_state(self):
+        if self.state is None:
+            return
+        meta = {}
+        if not self.first_run:
+            meta["first_run_done"] = "1"
+        for spec_key in self.helper_cursors:
+            meta["helper_cursor:" + spec_key] = self.helper_cursors[spec_key]
+        self.state.save(self.commits, self.ref_fingerprints, self.ref_tips,
+            self._changed_specs, meta)
+        self._changed_specs = set()
+
+
+    """
+    Builds the list of fetch jobs for one poll cycle, in the order their
+    results are merged. Each job fetches the git log records of one repo
+    spec, or of all repo specs of an SSH host; picking the new commits is
+    left to poll() so that the result is the same regardless of how the
+    jobs are scheduled.
+    """
+    def _poll_jobs(self, ssh_hosts, local_repos):
+        jobs = []
+        for host in ssh_hosts:
+            if not self.circuit_breaker.allow(host["host"]):
+                self.log("Skipping SSH host %s" % (
+                    self.circuit_breaker.describe(host["host"])), 1)
+                if self.scheduler is not None:
+                    # otherwise its repo specs stay due, and the next
+                    # poll would be right away
+                    retry = self.circuit_breaker.retry_time(host["host"])
+                    for repo in host["repos"]:
+                        key = self._repo_spec_key(repo, host)
+                        if self.shard is None or key in self.shard:
+                            self.scheduler.postpone(key, retry)
+                continue
+            repos = [repo for repo in host["repos"]
+                     if self._is_due(self._repo_spec_key(repo, host))]
+            if repos:
+                self.log("Checking SSH host '%s'" % host["host"], 1)
+            if self._host_config(host, "batch_repo_specs", True):
+                # all repo specs of the host in one command
+                batches = [repos]
+            else:
+                batches = [[repo] for repo in repos]
+            for batch in batches:
+                if not batch:
+                    continue
+                jobs.append({
+                    "host": host["host"],
+                    "specs": [{"key": self._repo_spec_key(repo, host),
+                        "context": {"host": host, "repo": repo}} for repo in batch],
+                    "fetch": lambda host=host, batch=batch: self._fetch_ssh_host_specs(host, batch),
+                })
+        for repo in local_repos:
+            if not self._is_due(self._repo_spec_key(repo)):
+                continue
+            jobs.append({
+                "host": "localhost",
+                "specs": [{"key": self._repo_spec_key(repo), "context": {"repo": repo}}],
+                "fetch": lambda repo=repo: [self._fetch_local_repo(repo)],
+            })
+        return jobs
+
+
+    def _is_due(self, spec_key):
+        if self.shard is not None and spec_key not in self.shard:
+            return False
+        if self.scheduler is None:
+            return True
+        return self.scheduler.is_due(spec_key)
+
+
+    """
+    Returns the keys of all configured repo specs
+    """
+    def repo_spec_keys(self):
+        keys = []
+        for host in self._config("ssh_hosts", []):
+            for repo in host["repos"]:
+                keys.append(self._repo_spec_key(repo, host))
+        for repo in self._config("local_repos", []):
+            keys.append(self._repo_spec_key(repo))
+        return keys
+
+
+    """
+    Runs the fetch jobs of a poll cycle, concurrently if poll_workers is
+    larger than 1, and returns (job, results) pairs in job order, with one
+    result per repo spec of the job.
+    No more than poll_host_concurrency jobs run against the same host
+    at the same time.
+    """
+    def _run_poll_jobs(self, jobs):
+        workers = min(self._config("poll_workers", 1), len(jobs))
+        if workers <= 1:
+            return [(job, self._run_job(job)) for job in jobs]
+
+        results = [None] * len(jobs)
+        errors = []
+        pending = Queue.Queue()
+        for index in range(0, len(jobs)):
+            pending.put(index)
+
+        host_limit = self._config("poll_host_concurrency", 4)
+        host_semaphores = {}
+        for job in jobs:
+            if not host_semaphores.has_key(job["host"]):
+                host_semaphores[job["host"]] = threading.BoundedSemaphore(host_limit)
+
+        def worker():
+            while not errors:
+                try:
+                    index = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                semaphore = host_semaphores[jobs[index]["host"]]
+                semaphore.acquire()
+                try:
+                    results[index] = self._run_job(jobs[index])
+                except Exception:
+                    errors.append(sys.exc_info())
+                finally:
+                    semaphore.release()
+
+        self.log("Polling %d repo specs in %d jobs using %d workers" % (
+            sum([len(job["specs"]) for job in jobs]), len(jobs), workers), 2)
+        threads = []
+        for i in range(0, workers):
+            thread = threading.Thread(target=worker, name="GitTail poll %d" % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+        return zip(jobs, results)
 
 
     """
@@ -261,16 +1142,57 @@ class GitTail():
     required to produce a list of commits in the format that
     _parse_git_log_result() expects.
     """
-    def _git_log_command(self):
-        commit_format = self._git_log_commit_delimiter.join(self._git_log_commit_data.values())
+    def _git_log_command(self, exclude=None, include=None):
+        commit_format = self._git_log_format_delimiter.join(self._git_log_commit_data.values())
+
+        if include:
+            # Commits of the given revisions only
+            revisions = " ".join(include)
+        else:
+            revisions = "--all"
+
+        if exclude:
+            # Commits added since the given ref tips were seen
+            # (tips that have since been garbage collected are ignored)
+            return 'git log --pretty=format:"commit=' + commit_format + '%n" --ignore-missing ' + revisions + ' --not ' + " ".join(exclude)
 
         # Time period to watch
         since = '1 day ago'
 
-        return 'git log --pretty=format:"commit=' + commit_format + '%n" --all --since="' + since + '"'
+        return 'git log --pretty=format:"commit=' + commit_format + '%n" ' + revisions + ' --since="' + since + '"'
+
+
+    """
+    Returns a command printing the current tip of every ref of the repo in
+    the current directory
+    """
+    def _ref_tips_command(self):
+        return 'git show-ref --head | sed "s/^/tip=/"'
+
+
+    """
+    Returns the key under which per repo spec state, such as the ref
+    fingerprints, is kept
+    """
+    def _repo_spec_key(self, repo, host=None):
+        if host is None:
+            hostname = "localhost"
+        else:
+            hostname = host["host"]
+        return "%s:%s/%s" % (hostname, repo.get("base_path", ""), repo["pattern"])
 
 
-    def _repo_iteration_command(self, repo):
+    """
+    Returns a command printing a fingerprint of all refs of the repo in the
+    current directory. The fingerprint changes whenever a ref is added,
+    removed or moved.
+    """
+    def _ref_fingerprint_command(self):
+        return 'refs=$( git show-ref --head | cksum )'
+
+
+    def _repo_iteration_command(self, repo, known_refs=None, known_tips=None,
+            repo_names=None, known_repos=None):
         cmd = []
 
         if repo.has_key('base_path'):
@@ -280,8 +1202,27 @@ class GitTail():
             # get absolute version of base_path
             cmd.append('base_path=`pwd`')
 
-        # repo_path exands to a list of repos
-        cmd.append('for repo in $( ls -d %s )' % repo['pattern'])
+        if repo_names is not None:
+            # only the given repos matching the pattern
+            cmd.append('for repo in %s' % " ".join(repo_names))
+        elif self._config("discovery_cache", True):
+            # add hint for _git_log_parse_result()
+            cmd.append('mtime=$( stat -c %Y . 2>/dev/null || stat -f %m . )')
+            if known_repos is not None:
+                # reuse the repos discovered earlier
+                # unless the base path has changed since
+                mtime, names = known_repos
+                cmd.append('if [[ $mtime == "%s" ]] ; then repos="%s"' % (
+                    mtime, " ".join(names)))
+                cmd.append('else repos=$( ls -d %s )' % repo['pattern'])
+                cmd.append('echo "discovered=$mtime" ; fi')
+            else:
+                cmd.append('repos=$( ls -d %s )' % repo['pattern'])
+                cmd.append('echo "discovered=$mtime"')
+            cmd.append('for repo in $repos')
+        else:
+            # repo_path exands to a list of repos
+            cmd.append('for repo in $( ls -d %s )' % repo['pattern'])
 
         # a valid repo is a directory
         # that either has the suffix ".git" (bare repo)
@@ -294,8 +1235,40 @@ class GitTail():
         # add hint for _git_log_parse_result()
         cmd.append('echo "repo=$repo"')
 
+        if self._config("detect_ref_changes", True):
+            # add hint for _git_log_parse_result()
+            cmd.append(self._ref_fingerprint_command())
+            cmd.append('echo "refs=$refs"')
+
+        if self._config("incremental_log", True):
+            # add hint for _git_log_parse_result()
+            changed = self._ref_tips_command()
+        else:
+            changed = None
+
+        cases = []
+        if known_refs:
+            # nothing to do in repos whose refs have not changed
+            # since the previous poll
+            cases.append('%s) ;;' % "|".join(['"%s %s"' % (name, known_refs[name])
+                for name in sorted(known_refs.keys())]))
+        if known_tips and changed:
+            # list new commits of repos with a known cursor separately,
+            # see _cursor_log_command()
+            cases.append('%s) %s ;;' % ("|".join(['"%s "*' % name
+                for name in sorted(known_tips.keys())]), changed))
+
         # add list of recent commits
-        cmd.append(self._git_log_command())
+        if changed:
+            changed = "%s ; %s" % (changed, self._git_log_command())
+        else:
+            changed = self._git_log_command()
+
+        if cases:
+            cmd.append('case "$repo $refs" in %s *) %s ;; esac' % (
+                " ".join(cases), changed))
+        else:
+            cmd.append(changed)
 
         if repo.has_key('base_path'):
             # cd back to base path before handling next repo
@@ -304,18 +1277,357 @@ class GitTail():
         cmd.append('fi')
         cmd.append('done')
 
-        return "/bin/bash -c '%s'" % " ; ".join(cmd).replace("'", "\\\'")
+        return " ; ".join([_utf8(part) for part in cmd])
+
+
+    """
+    Returns a command listing the commits added to each repo of the repo
+    spec since the given ref tips were seen, or only those reachable from
+    the revisions in includes if given for the repo
+    """
+    def _cursor_log_command(self, repo, ranges, includes={}):
+        cmd = []
+
+        if repo.has_key('base_path'):
+            cmd.append('cd %s' % repo['base_path'])
+
+        for name in sorted(ranges.keys()):
+            cmd.append('( cd %s && echo "repo=%s" && %s )' % (
+                name, name, self._git_log_command(ranges[name], includes.get(name))))
+
+        # failures in individual repos are reported on stderr
+        cmd.append('true')
+
+        return " ; ".join([_utf8(part) for part in cmd])
+
+
+    """
+    Runs the commands for polling a repo spec and returns the records of
+    their combined output. run is a function that executes a shell command
+    where the repos are located and returns the records read from its
+    output, or None on failure.
+    """
+    def _fetch_repo_spec(self, run, repo, host=None, repo_names=None):
+        return self._fetch_repo_specs(run, [repo], host, repo_names)[0]
+
+
+    """
+    Polls several repo specs of the same host like _fetch_repo_spec(),
+    running the commands of all of them at once. Returns the records of
+    each repo spec, or None for the repo specs that failed.
+    """
+    def _fetch_repo_specs(self, run, repos, host=None, repo_names=None):
+        keys = [self._repo_spec_key(repo, host) for repo in repos]
+        commands = []
+        for repo, spec_key in zip(repos, keys):
+            known_repos = None
+            if repo_names is None and self.discovery.has_key(spec_key):
+                mtime, discovered_at = self.discovery[spec_key]
+                if time.time() - discovered_at < self._config("discovery_interval", 3600):
+                    known_repos = (mtime, self.discovered_repos.get(spec_key, []))
+            commands.append(self._repo_iteration_command(repo,
+                self.ref_fingerprints.get(spec_key), self.ref_tips.get(spec_key, {}),
+                repo_names, known_repos))
+        results = self._run_repo_spec_commands(run, keys, commands)
+
+        # repos with a known cursor that printed new tips have changed
+        changed = []
+        for index in range(0, len(repos)):
+            known_tips = self.ref_tips.get(keys[index], {})
+            if results[index] is None or not known_tips:
+                continue
+            ranges = {}
+            current_repo = None
+            for record_type, value in results[index]:
+                if record_type == 'repo':
+                    current_repo = value
+                elif record_type == 'tip' and known_tips.has_key(current_repo):
+                    ranges[current_repo] = known_tips[current_repo]
+            if ranges:
+                self.log("Listing new commits in %d changed repositories" % len(ranges), 2)
+                changed.append((index, self._cursor_log_command(repos[index], ranges)))
+        if not changed:
+            return results
+
+        logs = self._run_repo_spec_commands(run,
+            [keys[index] for index, command in changed],
+            [command for index, command in changed])
+        for (index, command), log in zip(changed, logs):
+            if log is None:
+                # leave the cursors untouched and try again next poll
+                results[index] = None
+            else:
+                results[index] = results[index] + log
+        return results
+
+
+    """
+    Runs the commands of several repo specs with run, in one go if there is
+    more than one, and returns the records of each, or None for those that
+    did not finish
+    """
+    def _run_repo_spec_commands(self, run, keys, commands):
+        if len(commands) == 1:
+            return [run(commands[0])]
+        return [records if status is not None else None
+            for status, records in self._run_framed(run, keys, commands)]
+
+
+    """
+    Runs the commands of several repo specs as one shell command, framing
+    the output of each with spec= and status= lines. Returns the exit
+    status and records of each command, or (None, None) for those whose
+    output is missing or incomplete. The combined command is sent to run
+    as a whole, which passes it on stdin, so its size is not limited.
+    """
+    def _run_framed(self, run, keys, commands):
+        # keys are matched as utf-8, the way they are printed
+        keys = [_utf8(key) for key in keys]
+        sections = []
+        for key, command in zip(keys, commands):
+            sections.append('echo %s ; ( %s ) ; echo "status=$?"' % (
+                pipes.quote("spec=" + key), _utf8(command)))
+        result = run(" ; ".join(sections))
+        if result is None:
+            return [(None, None)] * len(keys)
+
+        records = {}
+        statuses = {}
+        current = None
+        for record_type, value in result:
+            if record_type == 'spec':
+                current = _utf8(value)
+                records[current] = []
+            elif record_type == 'status':
+                if current is not None:
+                    statuses[current] = int(value)
+                current = None
+            elif current is not None:
+                records[current].append((record_type, value))
+        return [(statuses.get(key), records.get(key)) for key in keys]
 
 
     """
     Fetches commit info from a remote server using SSH and git log
     """
     def poll_ssh_host(self, host, repo):
+        return self._parse_git_log_result(self._fetch_ssh_host(host, repo),
+            **{"host": host, "repo": repo})
+
+
+    """
+    Returns the git log records of a remote server
+    """
+    def _fetch_ssh_host(self, host, repo):
+        return self._fetch_ssh_host_specs(host, [repo])[0]
+
+
+    """
+    Returns the git log records of each of several repo specs of a remote
+    server, fetched over a single SSH connection
+    """
+    def _fetch_ssh_host_specs(self, host, repos):
+        for repo in repos:
+            self.log("Checking path '%s' for pattern '%s'" % (repo["base_path"], repo["pattern"]), 2)
+        self._ensure_ssh_session(host)
+        if self._host_config(host, "ssh_helper", False):
+            return self._fetch_with_helper(host, repos)
+        return self._fetch_repo_specs(
+            lambda command: self._run_ssh_command(host, command), repos, host)
+
+
+    """
+    Returns the source of the remote helper, see remote_helper.py, and the
+    path it is installed to on remote hosts. The path contains a hash of
+    the source, so that a changed helper is installed anew.
+    """
+    def _remote_helper(self):
+        if self._remote_helper_source is None:
+            f = open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                "remote_helper.py"))
+            try:
+                self._remote_helper_source = f.read()
+            finally:
+                f.close()
+        return self._remote_helper_source, "~/.gittail/helper-%s.py" % (
+            hashlib.sha1(self._remote_helper_source).hexdigest()[0:12])
+
+
+    """
+    Returns the command running the remote helper for a repo spec. Exits
+    with status 99 if the helper is not installed.
+    """
+    def _remote_helper_command(self, host, repo):
+        source, path = self._remote_helper()
+        spec_key = self._repo_spec_key(repo, host)
+        client_id = hashlib.sha1("%s@%s %s" % (getpass.getuser(),
+            socket.gethostname(), spec_key)).hexdigest()[0:16]
+        commit_format = self._git_log_format_delimiter.join(
+            self._git_log_commit_data.values())
+        args = [client_id, self.helper_cursors.get(spec_key, "-"),
+            repo.get("base_path", ""), repo["pattern"], "commit=" + commit_format]
+        return 'test -f %s || exit 99 ; exec "$( command -v python3 || command -v python )" %s %s' % (
+            path, path, " ".join([pipes.quote(_utf8(arg)) for arg in args]))
+
+
+    """
+    Copies the remote helper to a host
+    """
+    def _install_remote_helper(self, host):
+        source, path = self._remote_helper()
+        self.log("Installing remote helper on '%s'" % host["host"], 1)
+        args = self._ssh_args(host)
+        args.append("mkdir -p ~/.gittail && cat > %s.tmp && mv %s.tmp %s" % (
+            path, path, path))
+        returncode, result = self._run_command(args,
+            self._host_config(host, "command_timeout", 300), input=source)
+        return returncode == 0
+
+
+    """
+    Returns the git log records of each of several repo specs of a remote
+    server, as listed by the remote helper
+    """
+    def _fetch_with_helper(self, host, repos):
+        keys = [self._repo_spec_key(repo, host) for repo in repos]
+        commands = [self._remote_helper_command(host, repo) for repo in repos]
+        run = lambda command: self._run_ssh_command(host, command)
+
+        results = self._run_framed(run, keys, commands)
+        if 99 in [status for status, records in results]:
+            if not self._install_remote_helper(host):
+                self.log("Failed to install remote helper on '%s'" % host["host"])
+                return [None] * len(repos)
+            results = self._run_framed(run, keys, commands)
+        return [(None, records)[status == 0] for status, records in results]
+
+
+    """
+    Runs a command on a remote server and returns the records read from its
+    output, or None if the connection failed
+    """
+    def _run_ssh_command(self, host, command):
         env = os.environ
         env['PYTHONIOENCODING'] = 'utf-8'
 
+        args = self._ssh_args(host)
+        args.append("/bin/bash -s")
+
+        returncode, result = self._run_command(args,
+            self._host_config(host, "command_timeout", 300),
+            input=self._script_input(command), env=env)
+        if returncode == 255 or returncode is None:
+            # the connection may be dead, reconnect on the next poll
+            self._close_ssh_session(host)
+            return None
+        return result
+
+
+    """
+    Returns a setting that can be set per SSH host, falling back to the
+    global setting of the same name
+    """
+    def _host_config(self, host, name, default=None):
+        if host is not None and host.has_key(name):
+            return host[name]
+        return self._config(name, default)
+
+
+    """
+    Runs a command and parses its output with _read_git_log_records() while
+    it is still running. Returns the exit status and the list of records.
+    The records are kept until the command has finished, since its exit
+    status decides whether they are used.
+    stderr is collected in a temporary file, so that a chatty command
+    cannot block on a full pipe.
+
+    The command and everything it started is killed if it has not finished
+    within timeout seconds, in which case the exit status is None. input,
+    if given, is written to the standard input of the command. Both are None
+    if the command could not be started. stdout and stderr can be redirected
+    elsewhere with the keyword arguments of subprocess.Popen, in which case
+    no records are read or no errors logged.
+    """
+    def _run_command(self, args, timeout=None, input=None, **kwargs):
+        error_file = tempfile.TemporaryFile()
+        timed_out = []
+        if input is not None:
+            kwargs["stdin"] = subprocess.PIPE
+        kwargs.setdefault("stdout", subprocess.PIPE)
+        kwargs.setdefault("stderr", error_file)
+        try:
+            try:
+                p = subprocess.Popen(
+                    args,
+                    # unbuffered by default, which reads lines one byte at a time
+                    bufsize = -1,
+                    preexec_fn = os.setsid,
+                    **kwargs
+                )
+            except OSError, e:
+                self.log("subprocess error: %s" % e)
+                return None, None
+
+            def kill():
+                timed_out.append(True)
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+            timer = None
+            if timeout:
+                timer = threading.Timer(timeout, kill)
+                timer.daemon = True
+                timer.start()
+            try:
+                if input is not None:
+                    try:
+                        p.stdin.write(input)
+                        p.stdin.close()
+                    except IOError:
+                        # killed, or exited without reading it all
+                        pass
+                result = []
+                if p.stdout is not None:
+                    result = list(self._read_git_log_records(
+                        self._count_bytes(iter(p.stdout.readline, ''))))
+            finally:
+                if p.stdout is not None:
+                    p.stdout.close()
+                p.wait()
+                if timer is not None:
+                    timer.cancel()
+                    timer.join()
+            error_file.seek(0)
+            error = error_file.read().decode('utf-8', 'replace')
+        finally:
+            error_file.close()
+        if error != '':
+            self.log("subprocess error: '%s'" % error)
+        if timed_out:
+            self.log("subprocess error: killed after %d seconds" % timeout)
+            return None, result
+        return p.returncode, result
+
+
+    """
+    Returns the ssh command line for connecting to a host, without the
+    remote command. When ssh_multiplex is enabled the command is sent over
+    the host's shared control master connection if there is one.
+    """
+    def _ssh_args(self, host, control_master="no"):
         args = ["ssh"]
 
+        if self._config("ssh_multiplex", self._ssh_multiplex_default()):
+            args.append("-o")
+            args.append("ControlPath=%s" % self._ssh_control_path())
+            args.append("-o")
+            args.append("ControlMaster=%s" % control_master)
+
+        args.append("-o")
+        args.append("ConnectTimeout=%d" % self._host_config(host, "connect_timeout", 10))
+
         try:
             args.append("%s@%s" % (host["user"], host["host"]))
         except KeyError:
@@ -326,113 +1638,511 @@ class GitTail():
         except KeyError:
             pass
 
-        args.append(self._repo_iteration_command(repo))
-
-        p = subprocess.Popen(
-            args,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE,
-            env=env
-        )
-        result, error = p.communicate()
-        result = result.decode('utf-8')
-        error = error.decode('utf-8')
-        if error != '':
-            self.log("subprocess error: '%s'" % error)
-        return self._parse_git_log_result(result,
-            **{"host": host, "repo": repo})
+        return args
+
+
+    """
+    Connection multiplexing relies on Unix domain sockets, which
+    are not reliably available to ssh on Windows/Cygwin
+    """
+    def _ssh_multiplex_default(self):
+        return not sys.platform.startswith(("win", "cygwin"))
+
+
+    def _ssh_control_path(self):
+        control_dir = self._config("ssh_control_dir",
+            os.path.join(tempfile.gettempdir(), "gittail-%d" % os.getuid()))
+        if not os.path.isdir(control_dir):
+            try:
+                os.makedirs(control_dir, 0700)
+            except OSError:
+                if not os.path.isdir(control_dir):
+                    raise
+        # %C is a hash of the connection parameters, which keeps the socket
+        # path short enough for long host and user names
+        return os.path.join(control_dir, "%C")
+
+
+    """
+    Makes sure a healthy control master connection to the host exists,
+    starting a new one if the host has not been connected to yet or if the
+    previous connection has died. Polls started while no master is running
+    fall back to a connection of their own.
+    """
+    def _ensure_ssh_session(self, host):
+        if not self._config("ssh_multiplex", self._ssh_multiplex_default()):
+            return
+
+        with self._ssh_session_lock(host):
+            args = self._ssh_args(host)
+            args[1:1] = ["-O", "check"]
+            if self._run_ssh_control_command(host, args) == 0:
+                return
+
+            self.log("Opening SSH connection to '%s'" % host["host"], 1)
+            # remove a stale control socket left behind by a dead master
+            self._exit_ssh_master(host)
+
+            # keepalives let the master notice a dead connection, which
+            # -O check does not
+            args = self._ssh_args(host, "yes")
+            args[1:1] = ["-f", "-N",
+                "-o", "ControlPersist=%d" % self._config("ssh_control_persist", 600),
+                "-o", "ServerAliveInterval=%d" % self._host_config(host,
+                    "ssh_server_alive_interval", 15),
+                "-o", "ServerAliveCountMax=%d" % self._host_config(host,
+                    "ssh_server_alive_count_max", 3)]
+            if self._run_ssh_control_command(host, args) != 0:
+                self.log("Failed to open SSH connection to '%s'" % host["host"])
+
+
+    """
+    Returns the lock serializing the management of the control master
+    connection to a host
+    """
+    def _ssh_session_lock(self, host):
+        with self._ssh_sessions_lock:
+            return self._ssh_sessions.setdefault(host["host"], threading.Lock())
+
+
+    """
+    Closes the control master connection to a host after a poll through it
+    failed, so that _ensure_ssh_session() opens a new one for the next poll
+    """
+    def _close_ssh_session(self, host):
+        if not self._config("ssh_multiplex", self._ssh_multiplex_default()):
+            return
+        with self._ssh_session_lock(host):
+            self._exit_ssh_master(host)
+
+
+    """
+    Asks the control master connection to a host, if there is one, to exit
+    """
+    def _exit_ssh_master(self, host):
+        args = self._ssh_args(host)
+        args[1:1] = ["-O", "exit"]
+        self._run_ssh_control_command(host, args)
+
+
+    """
+    Runs an ssh command managing the control master connection to a host,
+    see _ssh_args(), and returns its exit status, or None if it did not
+    finish within connect_timeout seconds. It never prompts for a password.
+    Its output is discarded: the master started with -f keeps stdout open,
+    and a missing master is no error worth logging.
+    """
+    def _run_ssh_control_command(self, host, args):
+        args[1:1] = ["-o", "BatchMode=yes"]
+        devnull = open(os.devnull, "r+")
+        try:
+            returncode, result = self._run_command(args,
+                self._host_config(host, "connect_timeout", 10),
+                stdin=devnull, stdout=devnull, stderr=devnull)
+        finally:
+            devnull.close()
+        return returncode
+
+
+    """
+    Closes the control master connections opened by _ensure_ssh_session()
+    """
+    def close_ssh_sessions(self):
+        with self._ssh_sessions_lock:
+            hosts = self._ssh_sessions.keys()
+            self._ssh_sessions = {}
+
+        for host in self._config("ssh_hosts", []):
+            if host["host"] in hosts:
+                self._exit_ssh_master(host)
 
 
     """
     Fetches commit info from a local path using git log
     """
     def poll_local_repo(self, repo):
-        try:
-            env = os.environ
-            env['PYTHONIOENCODING'] = 'utf-8'
-            result = subprocess.check_output(
-                self._repo_iteration_command(repo), shell=True, env=env)
-        except subprocess.CalledProcessError, e:
-            self.log("subprocess error: '%s'" % e)
-            return
-        result = result.decode('utf-8')
-        return self._parse_git_log_result(result, **{"repo": repo})
+        return self._parse_git_log_result(self._fetch_local_repo(repo),
+            **{"repo": repo})
 
 
     """
-    Parses response from git log
+    Returns the git log records of local repositories
     """
-    def _parse_git_log_result(self, result, **kwargs):
-        new_commits = []
-        current_repo = None
-        for line in result.split("\n"):
-            if line[0:5] == 'repo=':
-                current_repo = line[5:]
-                self.log("Checking repository %s" % current_repo, 2)
-            elif line[0:7] == 'commit=':
+    def _fetch_local_repo(self, repo, repo_names=None):
+        self.log("Checking local path '%s' for pattern '%s'" % (repo["base_path"], repo["pattern"]), 2)
+        if self._config("native_local_reader", True):
+            try:
+                return self._read_local_repo_spec(repo, repo_names)
+            except UnsupportedRepository, e:
+                self.log("Using git for local path '%s': %s" % (repo["base_path"], e), 2)
+        return self._fetch_repo_spec(self._run_local_command, repo,
+            repo_names=repo_names)
+
+
+    """
+    Returns the same records as _fetch_repo_spec() for a local repo spec,
+    reading the repos without running git. Repos the reader does not
+    support are polled with git.
+    """
+    def _read_local_repo_spec(self, repo, repo_names=None):
+        spec_key = self._repo_spec_key(repo)
+        base_path = _utf8(os.path.expanduser(repo.get("base_path", ".")))
+        known_refs = self.ref_fingerprints.get(spec_key) or {}
+        known_tips = self.ref_tips.get(spec_key, {})
+        records = []
+
+        names = repo_names
+        if names is None and self._config("discovery_cache", True):
+            try:
+                mtime = str(int(os.stat(base_path).st_mtime))
+            except OSError, e:
+                raise UnsupportedRepository(str(e))
+            if self.discovery.has_key(spec_key) and self.discovery[spec_key][0] == mtime \
+                    and time.time() - self.discovery[spec_key][1] < self._config("discovery_interval", 3600):
+                names = self.discovered_repos.get(spec_key, [])
+            else:
+                records.append(('discovered', mtime))
+        if names is None:
+            # decoded like the output of git
+            names = [name.decode('utf-8', 'replace')
+                for name in list_repos(base_path, repo["pattern"])]
+
+        since = time.time() - 86400
+        unsupported = []
+        for name in names:
+            path = os.path.join(base_path, _utf8(name))
+            try:
+                records.extend(self._read_local_repository(path, name,
+                    known_refs, known_tips, since))
+            except (UnsupportedRepository, EnvironmentError), e:
+                self.log("Using git for repository %s: %s" % (name, e), 2)
+                unsupported.append(name)
+
+        if unsupported:
+            result = self._fetch_repo_spec(self._run_local_command, repo,
+                repo_names=unsupported)
+            if result is None:
+                return None
+            records.extend(result)
+        return records
+
+
+    """
+    Returns the reader of the local repo at path, see gitobjects.py
+    """
+    def _local_repository(self, path):
+        git_dir = os.path.join(path, ".git")
+        if not os.path.isdir(git_dir):
+            git_dir = path
+        repository = self._local_repositories.get(git_dir)
+        if repository is None:
+            repository = Repository(git_dir, self._commit_cache, self._delta_base_cache)
+            self._local_repositories[git_dir] = repository
+        return repository
+
+
+    """
+    Returns the records for one local repo, see _repo_iteration_command()
+    """
+    def _read_local_repository(self, path, name, known_refs, known_tips, since):
+        repository = self._local_repository(path)
+        records = [('repo', name)]
+        refs = repository.refs()
+        if self._config("detect_ref_changes", True):
+            fingerprint = repository.fingerprint(refs)
+            records.append(('refs', fingerprint))
+            if known_refs.get(name) == fingerprint:
+                return records
+
+        exclude = None
+        if self._config("incremental_log", True):
+            records.extend([('tip', sha) for ref_name, sha in refs])
+            exclude = known_tips.get(name)
+        if exclude:
+            commits = repository.log(refs, exclude=exclude)
+        else:
+            commits = repository.log(refs, since=since)
+        records.extend([('commit', Commit(**fields)) for fields in commits])
+        return records
+
+
+    """
+    Returns the standard input for running a shell command with bash -s.
+    The command is sent on stdin rather than as an argument, since the
+    known refs, tips and names of a repo spec easily exceed the size limit
+    of a single argument. It is run as one compound command, so bash reads
+    all of it before starting, and with stdin redirected so that nothing it
+    starts can read the rest of it.
+    """
+    def _script_input(self, command):
+        return "{ %s\n} < /dev/null\n" % _utf8(command)
+
+
+    """
+    Runs a command locally and returns the records read from its output,
+    or None if it failed
+    """
+    def _run_local_command(self, command):
+        env = os.environ
+        env['PYTHONIOENCODING'] = 'utf-8'
+        returncode, result = self._run_command(["/bin/bash", "-s"],
+            self._config("command_timeout", 300),
+            input=self._script_input(command), env=env)
+        if returncode is None:
+            return None
+        if returncode != 0:
+            self.log("subprocess error: '%s' returned non-zero exit status %d" % (
+                command, returncode))
+            return None
+        return result
+
+
+    """
+    Adds the length of the lines read to the byte count of the job
+    being run by the current thread
+    """
+    def _count_bytes(self, lines):
+        stats = getattr(self._job_stats, 'current', None)
+        for line in lines:
+            if stats is not None:
+                if line[0:5] == 'spec=':
+                    # output of the next repo spec of a batch
+                    stats["spec"] = line[5:].rstrip("\n").decode('utf-8', 'replace')
+                    self._label_activity("fetch %s" % stats["spec"])
+                stats["bytes"][stats["spec"]] = stats["bytes"].get(stats["spec"], 0) + len(line)
+            yield line
+
+
+    """
+    Parses the output of the commands built by _repo_iteration_command()
+    and _cursor_log_command(), one line at a time, and yields a record for
+    each line as soon as it has been read: ('repo', name),
+    ('refs', fingerprint), ('tip', hash) or ('commit', Commit), and
+    ('spec', key) and ('status', exit status) around the output of each
+    repo spec of a batch, see _run_framed()
+    """
+    def _read_git_log_records(self, lines):
+        fields = self._git_log_commit_data.keys()
+        # positions of the arguments of Commit() in the output
+        positions = [fields.index(name) for name in Commit.fields]
+        for line in lines:
+            if not isinstance(line, unicode):
+                line = line.decode('utf-8', 'replace')
+            line = line.rstrip("\n")
+            if line[0:7] == 'commit=':
                 commit_parts = line[7:].split(self._git_log_commit_delimiter)
-                commit_parts.reverse()
-                commit = {}
-                for id in self._git_log_commit_data.keys():
-                    commit[id] = commit_parts.pop()
-                commit['repo'] = current_repo
+                if len(commit_parts) != len(fields):
+                    self.log("Failed to parse commit '%s'" % line[7:], 1)
+                    continue
+                commit = Commit(*[commit_parts[i] for i in positions])
                 try:
-                    gitweb_baseurl = kwargs['repo']['gitweb_baseurl']
-                    commit['url'] = "%s?p=%s;a=commitdiff;h=%s" % (
-                        gitweb_baseurl, current_repo, commit['hash'])
-                except KeyError:
-                    pass
+                    commit.commit_time = int(commit.commit_time)
+                except ValueError:
+                    self.log("Failed to parse commit '%s'" % line[7:], 1)
+                    continue
+                yield ('commit', commit)
+            elif line[0:5] == 'repo=':
+                yield ('repo', line[5:])
+            elif line[0:5] == 'refs=':
+                yield ('refs', line[5:])
+            elif line[0:4] == 'tip=':
+                yield ('tip', line[4:].split(" ")[0])
+            elif line[0:7] == 'cursor=':
+                yield ('cursor', line[7:])
+            elif line[0:11] == 'discovered=':
+                yield ('discovered', line[11:])
+            elif line[0:5] == 'spec=':
+                yield ('spec', line[5:])
+            elif line[0:7] == 'status=':
+                yield ('status', line[7:])
 
-                if not commit.has_key('url'):
-                    try:
-                        github_path = kwargs['repo']['github_paths'][current_repo]
-                        commit['url'] = "https://github.com/%s/commit/%s" % (
-                            github_path, commit['hash'])
-                    except KeyError:
-                        pass
 
-                if not self.commits.has_key(commit['hash']):
+    """
+    Returns the output that _read_git_log_records() reads records from,
+    e.g. to record it, see recording.py
+    """
+    def _format_git_log_records(self, records):
+        fields = self._git_log_commit_data.keys()
+        lines = []
+        for record_type, value in records:
+            if record_type == 'commit':
+                lines.append(u"commit=" + self._git_log_commit_delimiter.join(
+                    [unicode(value[name]) for name in fields]))
+            elif record_type not in ('spec', 'status'):
+                lines.append(u"%s=%s" % (record_type, value))
+        return u"".join([line + u"\n" for line in lines])
+
+
+    """
+    Picks the new commits from the records of a git log response, or from
+    the raw response itself, and updates the fingerprints and cursors of
+    the repos listed
+    """
+    def _parse_git_log_result(self, result, **kwargs):
+        new_commits = []
+        if result is None:
+            return new_commits
+        if isinstance(result, basestring):
+            result = self._read_git_log_records(result.splitlines())
+        spec_key = self._repo_spec_key(kwargs['repo'], kwargs.get('host'))
+        ref_fingerprints = {}
+        ref_tips = {}
+        current_repo = None
+        for record_type, value in result:
+            if record_type == 'repo':
+                current_repo = intern_string(value)
+                if not ref_tips.has_key(current_repo):
+                    self.log("Checking repository %s" % current_repo, 2)
+                    ref_tips[current_repo] = None
+            elif record_type == 'refs':
+                ref_fingerprints[current_repo] = value
+            elif record_type == 'cursor':
+                self.helper_cursors[spec_key] = value
+            elif record_type == 'discovered':
+                # the repos listed have been discovered anew
+                self.discovery[spec_key] = (value, time.time())
+            elif record_type == 'tip':
+                if ref_tips[current_repo] is None:
+                    ref_tips[current_repo] = []
+                if value not in ref_tips[current_repo]:
+                    ref_tips[current_repo].append(value)
+            elif record_type == 'commit':
+                commit = value
+                if commit.hash not in self.commits:
+                    # the URL is built from the repo spec when needed
+                    commit.repo = current_repo
+                    commit.spec = kwargs['repo']
                     new_commits.append(commit)
-                    self.log("Found new commit %s" % str(commit), 3)
-                else:
+                    if self.verbosity >= 3:
+                        self.log("Found new commit %s" % str(commit), 3)
+                elif self.verbosity >= 4:
+                    commit.repo = current_repo
                     self.log("Found previously seen commit %s" % str(commit), 4)
 
-                self.commits[commit['hash']] = commit
+                self.commits.add(commit.hash)
+
+        if kwargs.get('repo_names') is None:
+            # sorted, so that the native reader polls them in the order
+            # the commands list the new commits of changed repos in
+            self.discovered_repos[spec_key] = sorted(ref_tips.keys())
+        else:
+            # only some of the repos were polled, keep the state of the others
+            merged = dict(self.ref_fingerprints.get(spec_key, {}))
+            merged.update(ref_fingerprints)
+            ref_fingerprints = merged
+
+        if ref_fingerprints:
+            self.ref_fingerprints[spec_key] = ref_fingerprints
+            self._changed_specs.add(spec_key)
+
+        # move the cursors of changed repos to their new tips
+        known_tips = self.ref_tips.get(spec_key, {})
+        if kwargs.get('repo_names') is not None:
+            for name in known_tips:
+                if not ref_tips.has_key(name):
+                    ref_tips[name] = None
+        for name in ref_tips.keys():
+            if ref_tips[name] is None:
+                if known_tips.has_key(name):
+                    ref_tips[name] = known_tips[name]
+                else:
+                    del ref_tips[name]
+        if ref_tips:
+            self.ref_tips[spec_key] = ref_tips
+            self._changed_specs.add(spec_key)
 
         new_commits.reverse()
 
         return new_commits
 
 
+    """
+    Returns the compiled template for a template path, preferring the custom
+    template directory over the bundled templates, or None if neither has
+    it. Lookups are cached for the lifetime of GitTail.
+    """
+    def _get_template(self, template_path):
+        try:
+            return self._template_cache[template_path]
+        except KeyError:
+            pass
+
+        self._load_templates()
+
+        template = None
+        environments = []
+        if hasattr(self, 'jinja2_custom_templates'):
+            environments.append(self.jinja2_custom_templates)
+        environments.append(self.jinja2_default_templates)
+        for environment in environments:
+            try:
+                template = environment.get_template(template_path)
+                break
+            except self.jinja2_exceptions.TemplateNotFound:
+                pass
+
+        self._template_cache[template_path] = template
+        return template
+
+
     def _render_template(self, template_path, data, default_value = None):
         data['default_value'] = default_value
 
+        self._load_templates()
         if not self._config("use_templates", True):
             return default_value
 
-        try:
-            template = self.jinja2_custom_templates.get_template(template_path)
-            return template.render(**data)
-        except (AttributeError, self.jinja2_exceptions.TemplateNotFound), e:
-            try:
-                template = self.jinja2_default_templates.get_template(template_path)
-                return template.render(**data)
-            except self.jinja2_exceptions.TemplateNotFound, e:
-                if default_value:
-                    return default_value
-                raise e
+        template = self._get_template(template_path)
+        if template is None:
+            if default_value:
+                return default_value
+            raise self.jinja2_exceptions.TemplateNotFound(template_path)
+        return template.render(**data)
+
+
+    """
+    Describes a commit timestamp relative to now, like git's %cr
+    """
+    def _relative_time(self, timestamp):
+        age = max(0, int(time.time()) - timestamp)
+        if age < 90:
+            return "%d seconds ago" % age
+        if age < 90 * 60:
+            return "%d minutes ago" % round(age / 60.0)
+        if age < 36 * 3600:
+            return "%d hours ago" % round(age / 3600.0)
+        return "%d days ago" % round(age / 86400.0)
 
 
     def _render_message(self, message_type, data, target):
-        message = {}
+        return self._render_messages(message_type, data, [target])[target]
+
+
+    """
+    Renders a notification for each of the given targets. The template
+    data shared by the targets is prepared once.
+    """
+    def _render_messages(self, message_type, data, targets):
+        messages = {}
+        if not targets:
+            return messages
+
         data['timestamp'] = time.strftime("%Y-%m-%d %H:%M:%S")
-        data['indent_ts'] = "".join([" " for x in range(0,len(data['timestamp']))])
+        data['indent_ts'] = " " * len(data['timestamp'])
+
+        """"
+        notification with results of the first pass after starting GitTail
+        """
+        if message_type == 'commit_digest_first_run':
+            data['title'] = 'Commit activity last 24 hours'
+            message_type = 'commit_digest'
 
         """
         notification for a single commit
         """
         if message_type == 'commit':
             commit = data['commit']
+            commit['time'] = self._relative_time(commit['commit_time'])
 
             data['title'] = "%s committed" % commit['committer']
 
@@ -443,39 +2153,46 @@ class GitTail():
             if commit['author'] != commit['committer']:
                 default_body.append("Author: %s" % commit['author'])
             default_body.append(commit['hash'])
+            default_text = "\n".join(default_body)
+
+            for target in targets:
+                message = {}
+
+                if target == 'console':
+                    console_body = default_body
+                    if commit.has_key('url'):
+                        console_body = default_body + [commit['url']]
+                    message['message'] = self._render_template(
+                        'console/commit/message.txt',
+                        data,
+                        "\n%s %s\n%s\n" % (
+                            data['timestamp'],
+                            data['title'],
+                            "\n".join(console_body)))
 
-            if target == 'console':
-                if commit.has_key('url'):
-                    default_body.append(commit['url'])
-                message['message'] = self._render_template(
-                    'console/commit/message.txt',
-                    data,
-                    "\n%s %s\n%s\n" % (
-                        data['timestamp'],
-                        data['title'],
-                        "\n".join(default_body)))
+                elif target == 'growl':
+                    message['title'] = self._render_template(
+                        'growl/commit/title.txt', data, data['title'])
 
-            elif target == 'growl':
-                message['title'] = self._render_template(
-                    'growl/commit/title.txt', data, data['title'])
+                    message['text'] = self._render_template(
+                        'growl/commit/text.txt', data, default_text)
 
-                message['text'] = self._render_template(
-                    'growl/commit/text.txt', data, "\n".join(default_body))
+                    if commit.has_key('url'):
+                        message['callback'] = commit['url']
 
-                if commit.has_key('url'):
-                    message['callback'] = commit['url']
+                elif target == 'libnotify':
+                    message['summary'] = self._render_template(
+                        'libnotify/commit/summary.txt', data, data['title'])
 
-            elif target == 'libnotify':
-                message['summary'] = self._render_template(
-                    'libnotify/commit/summary.txt', data, data['title'])
+                    libnotify_body = default_text
+                    if commit.has_key('url'):
+                        libnotify_body = '<a href="%s">%s</a>' % (
+                            commit['url'], default_text)
 
-                default_body = "\n".join(default_body)
-                if commit.has_key('url'):
-                    default_body = '<a href="%s">%s</a>' % (
-                        commit['url'], default_body)
+                    message['body'] = self._render_template(
+                        'libnotify/commit/body.html', data, libnotify_body)
 
-                message['body'] = self._render_template(
-                    'libnotify/commit/body.html', data, default_body)
+                messages[target] = message
 
 
         """
@@ -504,53 +2221,180 @@ class GitTail():
                     default_body.append("%s %d %s" % (author, commits_per_author[author],
                         ('commits', 'commit')[commits_per_author[author] == 1]))
                 data['commits_per_author'] = commits_per_author
+            default_text = "\n".join(default_body)
 
-            if target == 'console':
-                message['message'] = self._render_template(
-                    'console/commit_digest/message.txt',
-                    data,
-                    "\n%s %s\n%s\n" % (
-                        data['timestamp'],
-                        data['title'],
-                        "\n".join(default_body)))
-
-            elif target == 'growl':
-                message['title'] = self._render_template(
-                    'growl/commit_digest/title.txt',
-                    data,
-                    data['title'])
-
-                message['text'] = self._render_template(
-                    'growl/commit_digest/text.txt',
-                    data,
-                    "\n".join(default_body))
-
-            elif target == 'libnotify':
-                message['summary'] = self._render_template(
-                    'libnotify/commit_digest/summary.txt',
-                    data,
-                    data['title'])
-
-                message['body'] = self._render_template(
-                    'libnotify/commit_digest/body.html',
-                    data,
-                    "\n".join(default_body))
+            for target in targets:
+                message = {}
 
-        """"
-        notification with results of the first pass after starting GitTail
-        """
-        if message_type == 'commit_digest_first_run':
-            data['title'] = 'Commit activity last 24 hours'
-            message = self._render_message('commit_digest', data, target)
+                if target == 'console':
+                    message['message'] = self._render_template(
+                        'console/commit_digest/message.txt',
+                        data,
+                        "\n%s %s\n%s\n" % (
+                            data['timestamp'],
+                            data['title'],
+                            default_text))
+
+                elif target == 'growl':
+                    message['title'] = self._render_template(
+                        'growl/commit_digest/title.txt',
+                        data,
+                        data['title'])
+
+                    message['text'] = self._render_template(
+                        'growl/commit_digest/text.txt',
+                        data,
+                        default_text)
+
+                elif target == 'libnotify':
+                    message['summary'] = self._render_template(
+                        'libnotify/commit_digest/summary.txt',
+                        data,
+                        data['title'])
+
+                    message['body'] = self._render_template(
+                        'libnotify/commit_digest/body.html',
+                        data,
+                        default_text)
+
+                messages[target] = message
+
+        return messages
+
+
+    """
+    Starts watching the local repos discovered by the latest poll
+    """
+    def _watch_local_repos(self):
+        if self.watcher is None:
+            return
+        keys = set()
+        for index, repo in enumerate(self._config("local_repos", [])):
+            base_path = _utf8(os.path.expanduser(repo.get("base_path", "")))
+            for name in self.discovered_repos.get(self._repo_spec_key(repo), []):
+                if self.watcher.watch((index, name), os.path.join(base_path, _utf8(name))):
+                    keys.add((index, name))
+        self.watcher.retain(keys)
+
+
+    """
+    Waits until the given time. Local repos that change meanwhile are
+    polled right away when a repo watcher is running.
+    """
+    def _sleep_until(self, next_poll):
+        while True:
+            remaining = next_poll - time.time()
+            if remaining <= 0:
+                return
+            if self.pushes is not None:
+                if self.watcher is None:
+                    pushes = self._wait_for_pushes(remaining)
+                else:
+                    # the watcher cannot be woken by pushes
+                    pushes = self._wait_for_pushes(0)
+                    remaining = min(remaining, 0.2)
+                if pushes:
+                    self.poll_pushes(pushes)
+                if self.watcher is None:
+                    continue
+            if self.watcher is None:
+                time.sleep(remaining)
+                continue
+            changed = self.watcher.wait(remaining)
+            if changed:
+                self.poll_local_changes(changed)
 
-        return message
+
+    """
+    Waits at most timeout seconds for pushes, and returns those received
+    """
+    def _wait_for_pushes(self, timeout):
+        pushes = []
+        try:
+            if timeout > 0:
+                pushes.append(self.pushes.get(True, timeout))
+            while True:
+                pushes.append(self.pushes.get_nowait())
+        except Queue.Empty:
+            pass
+        return pushes
+
+
+    def wait_for_next_poll(self):
+        if self.scheduler is not None and self.scheduler.next_due() is not None:
+            next_poll = self.scheduler.next_due()
+            self.log("Sleeping %d seconds until the next repo is due" % (
+                max(0, next_poll - time.time())), 1)
+            self._sleep_until(next_poll)
+            return
+        interval = self._config("poll_interval", 60)
+        if self.pushes is not None:
+            # pushes are fetched when received, polling only catches
+            # what was missed
+            interval = self._config("push_poll_interval", 900)
+        self.log("Sleeping %d seconds" % interval, 1)
+        self._sleep_until(time.time() + interval)
+
+
+    """
+    Closes connections and files, and sends pending notifications
+    """
+    def close(self):
+        if self.push_server is not None:
+            self.push_server.stop()
+        self.close_ssh_sessions()
+        if self.watcher is not None:
+            self.watcher.close()
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+        if self.state is not None:
+            self.state.close()
+        if self.recorder is not None:
+            self.recorder.close()
 
 
     def run(self):
-        while self.poll():
-            interval = self._config("poll_interval", 60)
-            self.log("Sleeping %d seconds" % interval, 1)
-            time.sleep(interval)
+        try:
+            while self.poll():
+                self.wait_for_next_poll()
+        finally:
+            self.close()
+
+
+    """
+    Runs like run() until at least cycles poll cycles have been profiled,
+    and writes the profile to output.txt (cumulative stats) and
+    output.collapsed (stacks for flamegraph.pl), see profiling.py. With a
+    replayer, profiles the first cycles cycles it replays instead of
+    polling.
+    """
+    def run_profiled(self, cycles, output, deterministic=False, replayer=None):
+        from profiling import Profiler
+        self.profiler = Profiler(deterministic)
+        try:
+            if replayer is not None:
+                replayer.run(cycles)
+            else:
+                while self.poll() and self.profiler.cycles < cycles:
+                    self.wait_for_next_poll()
+        finally:
+            self.profiler.close()
+            self.profiler.write_stats(output + ".txt")
+            self.profiler.write_collapsed(output + ".collapsed")
+            self.log("Profile of %d poll cycles written to %s.txt and "
+                "%s.collapsed" % (self.profiler.cycles, output, output))
+            self.close()
+
+
+    """
+    Polls once, sends the notifications and exits. Returns False if no
+    repos are configured.
+    """
+    def run_once(self):
+        try:
+            return self.poll()
+        finally:
+            self.close()
 
 
 def main():
@@ -569,7 +2413,59 @@ def main():
                 information printed to the console""")
     parser.add_argument('-q', '--quiet', action='count',
         help='suppress non-error console messages')
+    parser.add_argument('--coordinator', metavar='ADDRESS',
+        help="""coordinate worker processes listening at host:port or at the
+                path of a Unix socket, instead of polling""")
+    parser.add_argument('--worker', metavar='ADDRESS',
+        help="""poll the repo specs assigned by the coordinator at ADDRESS
+                and report new commits to it""")
+    parser.add_argument('--worker-id',
+        help='name of this worker (default: hostname:pid)')
+    parser.add_argument('--serve', metavar='ADDRESS',
+        help="""publish new commits to subscribers connecting to host:port
+                or to the path of a Unix socket, instead of notifying""")
+    parser.add_argument('--subscribe', metavar='ADDRESS',
+        help="""notify about the commits published by the GitTail serving
+                at ADDRESS, instead of polling""")
+    parser.add_argument('--once', action='store_true',
+        help="""poll once and exit, e.g. when run from cron or a systemd
+                timer. Commits seen are kept in state_file between runs
+                (default: ~/.gittail.sqlite)""")
+    parser.add_argument('--profile', type=int, metavar='CYCLES',
+        help="""profile CYCLES poll cycles, write the profile and exit""")
+    parser.add_argument('--profile-output', metavar='PATH',
+        default='gittail-profile',
+        help="""write the cumulative stats of the profile to PATH.txt and
+                the stacks sampled to PATH.collapsed, for flamegraph.pl
+                (default: gittail-profile)""")
+    parser.add_argument('--profile-deterministic', action='store_true',
+        help="""measure the cumulative stats with cProfile instead of
+                computing them from the samples""")
+    parser.add_argument('--record', metavar='PATH',
+        help="""append the output read by every poll cycle to the gzip
+                compressed file PATH, for --replay""")
+    parser.add_argument('--replay', metavar='PATH',
+        help="""parse and notify about the poll cycles recorded in PATH
+                with --record, as far apart as they were, instead of
+                polling""")
+    parser.add_argument('--replay-fast', action='store_true',
+        help='replay the poll cycles as fast as possible')
     args = parser.parse_args()
+    if args.serve != None and args.worker != None:
+        parser.error("--serve cannot be combined with --worker")
+    if args.profile != None and (args.once or args.subscribe != None or
+            args.coordinator != None or args.worker != None):
+        parser.error("--profile cannot be combined with --once, --subscribe, "
+            "--coordinator or --worker")
+    if args.replay != None and (args.once or args.subscribe != None or
+            args.coordinator != None or args.worker != None or
+            args.record != None):
+        parser.error("--replay cannot be combined with --once, --subscribe, "
+            "--coordinator, --worker or --record")
+    if args.record != None and (args.subscribe != None or
+            args.coordinator != None):
+        parser.error("--record cannot be combined with --subscribe or "
+            "--coordinator, which do not poll")
 
     if args.config == None:
         # Use bundled config file
@@ -593,8 +2489,58 @@ def main():
     if args.quiet != None:
         gittail_config_dict["quiet"] = args.quiet
 
+    if args.once:
+        # nothing to watch for between polls, and without state every
+        # run would be a first run
+        gittail_config_dict["watch_local_repos"] = False
+        if not gittail_config_dict.get("state_file"):
+            gittail_config_dict["state_file"] = "~/.gittail.sqlite"
+
+    if args.replay != None:
+        # replay as a GitTail that has not seen anything yet, without
+        # touching the state of the one that polls
+        gittail_config_dict["state_file"] = None
+        gittail_config_dict["watch_local_repos"] = False
+        gittail_config_dict["push_address"] = None
+
     client = GitTail(config=gittail_config_dict)
-    client.run()
+    if args.record != None:
+        from recording import Recorder
+        Recorder(client, os.path.expanduser(args.record))
+    if args.serve != None:
+        from pubsub import PublishServer
+        PublishServer(client, args.serve,
+            client._config("publish_replay_size", 100)).start()
+
+    if args.subscribe != None:
+        from pubsub import Subscriber
+        Subscriber(client, args.subscribe).run()
+    elif args.once:
+        if not client.run_once():
+            sys.exit(1)
+    elif args.coordinator != None:
+        from shard import Coordinator
+        Coordinator(client, args.coordinator).serve_forever()
+    elif args.worker != None:
+        from shard import ShardWorker
+        ShardWorker(client, args.worker, args.worker_id).run()
+    elif args.replay != None:
+        from recording import Replayer
+        replayer = Replayer(client, os.path.expanduser(args.replay),
+            not args.replay_fast)
+        if args.profile != None:
+            client.run_profiled(args.profile, args.profile_output,
+                args.profile_deterministic, replayer)
+        else:
+            try:
+                replayer.run()
+            finally:
+                client.close()
+    elif args.profile != None:
+        client.run_profiled(args.profile, args.profile_output,
+            args.profile_deterministic)
+    else:
+        client.run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Accepts notices of pushes from post-receive hooks, so that GitTail can
+fetch the pushed commits right away instead of at the next poll.
+
+At "host:port", pushes are POSTed over HTTP. At the path of a Unix socket,
+they are sent one per line. Either way a push is a JSON object:
+
+    {"host": "example.com", "repo": "/srv/git/project.git",
+     "old": SHA, "new": SHA, "ref": "refs/heads/master"}
+
+host is left out for local repos. repo is either the path of the
+repository or its name relative to the base path of a repo spec. Several
+refs updated by the same push can be sent together as
+{"host": ..., "repo": ..., "updates": [{"old": ..., "new": ..., "ref": ...}]}.
+"""
+
+import json
+import re
+import socket
+import SocketServer
+import threading
+
+from shard import listen, parse_address
+
+
+NULL_SHA = "0" * 40
+
+_sha_pattern = re.compile("^[0-9a-f]{40}$")
+# refs are passed to git through a shell
+_ref_pattern = re.compile("^refs/[A-Za-z0-9._/@+-]+$")
+
+
+"""
+Returns the ref updates described by a push as a list of dicts with the
+keys host, repo, old, new and ref. Raises ValueError if the push is
+malformed.
+"""
+def parse_push(payload):
+    if not isinstance(payload, dict):
+        raise ValueError("a push must be a JSON object")
+    updates = payload.get("updates", [payload])
+    if not isinstance(updates, list):
+        raise ValueError("updates must be a list")
+    if not isinstance(payload.get("repo"), basestring) or not payload["repo"]:
+        raise ValueError("repo is missing")
+
+    result = []
+    for update in updates:
+        if not isinstance(update, dict):
+            raise ValueError("an update must be a JSON object")
+        old = update.get("old") or NULL_SHA
+        new = update.get("new") or NULL_SHA
+        ref = update.get("ref", "")
+        if not isinstance(old, basestring) or not isinstance(new, basestring) \
+                or not _sha_pattern.match(old) or not _sha_pattern.match(new):
+            raise ValueError("old and new must be full commit hashes")
+        if not isinstance(ref, basestring) or not _ref_pattern.match(ref):
+            raise ValueError("invalid ref %r" % ref)
+        result.append({
+            "host": payload.get("host") or None,
+            "repo": payload["repo"],
+            "old": old,
+            "new": new,
+            "ref": ref,
+        })
+    return result
+
+
+class PushServer():
+    def __init__(self, address, pushes, log):
+        self.address = address
+        self.pushes = pushes
+        self.log = log
+
+
+    def _accept(self, body):
+        updates = parse_push(json.loads(body))
+        for update in updates:
+            self.pushes.put(update)
+        self.log("Received push of %d refs of %s" % (len(updates),
+            updates[0]["repo"]), 2)
+        return len(updates)
+
+
+    def start(self):
+        server = self
+
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX:
+            class Handler(SocketServer.StreamRequestHandler):
+                def handle(self):
+                    for line in self.rfile:
+                        try:
+                            reply = "ok %d\n" % server._accept(line)
+                        except ValueError, e:
+                            reply = "error %s\n" % e
+                        self.wfile.write(reply)
+                        self.wfile.flush()
+        else:
+            import BaseHTTPServer
+
+            class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+                def do_POST(self):
+                    try:
+                        length = int(self.headers.get("Content-Length", 0))
+                        body = json.dumps({"accepted": server._accept(self.rfile.read(length))})
+                        self.send_response(202)
+                    except ValueError, e:
+                        body = json.dumps({"error": str(e)})
+                        self.send_response(400)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+        self.server = listen(self.address, Handler)
+        thread = threading.Thread(target=self.server.serve_forever,
+            name="GitTail push server")
+        thread.daemon = True
+        thread.start()
+        self.log("Accepting pushes at %s" % self.address, 1)
+
+
+    def stop(self):
+        self.server.shutdown()
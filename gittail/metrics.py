@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Counters describing what GitTail's poll cycles spend their time on, and
+their export as a Prometheus text file or HTTP endpoint and as JSON lines.
+"""
+
+import json
+import os
+import threading
+import time
+
+
+"""
+Collects per repo spec and per notification type metrics of poll cycles
+"""
+class PollMetrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cycles = 0
+        self.cycle_seconds = 0.0
+        self.cycle_seconds_total = 0.0
+        # (host, spec key) -> dict of counters
+        self.specs = {}
+        # message type -> [count, seconds]
+        self.notifications = {}
+        # job records of the current cycle, written as one JSON line
+        self._cycle_jobs = []
+
+
+    def record_job(self, host, spec, seconds, parse_seconds, bytes, parsed,
+            new, failed):
+        with self.lock:
+            spec_metrics = self.specs.setdefault((host, spec), {
+                "polls": 0, "seconds": 0.0, "seconds_total": 0.0,
+                "parse_seconds_total": 0.0, "bytes_total": 0,
+                "commits_parsed_total": 0, "new_commits_total": 0,
+                "errors_total": 0, "last_success": 0,
+            })
+            spec_metrics["polls"] += 1
+            spec_metrics["seconds"] = seconds
+            spec_metrics["seconds_total"] += seconds
+            spec_metrics["parse_seconds_total"] += parse_seconds
+            spec_metrics["bytes_total"] += bytes
+            spec_metrics["commits_parsed_total"] += parsed
+            spec_metrics["new_commits_total"] += new
+            if failed:
+                spec_metrics["errors_total"] += 1
+            else:
+                spec_metrics["last_success"] = int(time.time())
+            self._cycle_jobs.append({
+                "host": host, "spec": spec, "seconds": round(seconds, 6),
+                "parse_seconds": round(parse_seconds, 6), "bytes": bytes,
+                "commits_parsed": parsed, "new_commits": new, "failed": failed,
+            })
+
+
+    def record_notify(self, message_type, seconds):
+        with self.lock:
+            counts = self.notifications.setdefault(message_type, [0, 0.0])
+            counts[0] += 1
+            counts[1] += seconds
+
+
+    """
+    Ends a poll cycle and returns a summary of it
+    """
+    def record_cycle(self, seconds):
+        with self.lock:
+            self.cycles += 1
+            self.cycle_seconds = seconds
+            self.cycle_seconds_total += seconds
+            jobs = self._cycle_jobs
+            self._cycle_jobs = []
+        return {
+            "time": int(time.time()),
+            "seconds": round(seconds, 6),
+            "specs": len(jobs),
+            "bytes": sum([job["bytes"] for job in jobs]),
+            "commits_parsed": sum([job["commits_parsed"] for job in jobs]),
+            "new_commits": sum([job["new_commits"] for job in jobs]),
+            "errors": len([job for job in jobs if job["failed"]]),
+            "jobs": jobs,
+        }
+
+
+    """
+    Returns the metrics in the Prometheus text exposition format
+    """
+    def prometheus(self):
+        lines = []
+
+        def metric(name, metric_type, help, samples):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for labels, value in samples:
+                if labels:
+                    lines.append("%s{%s} %s" % (name, ",".join(
+                        ['%s="%s"' % (key, _escape(labels[key]))
+                         for key in sorted(labels.keys())]), value))
+                else:
+                    lines.append("%s %s" % (name, value))
+
+        with self.lock:
+            metric("gittail_poll_cycles_total", "counter",
+                "Number of poll cycles", [({}, self.cycles)])
+            metric("gittail_poll_cycle_seconds", "gauge",
+                "Duration of the latest poll cycle", [({}, self.cycle_seconds)])
+            metric("gittail_poll_cycle_seconds_total", "counter",
+                "Total duration of all poll cycles", [({}, self.cycle_seconds_total)])
+
+            specs = sorted(self.specs.keys())
+            for name, key, metric_type, help in [
+                    ("gittail_repo_polls_total", "polls", "counter",
+                     "Number of polls of the repo spec"),
+                    ("gittail_repo_poll_seconds", "seconds", "gauge",
+                     "Duration of the latest poll of the repo spec"),
+                    ("gittail_repo_poll_seconds_total", "seconds_total", "counter",
+                     "Total time spent polling the repo spec"),
+                    ("gittail_repo_parse_seconds_total", "parse_seconds_total", "counter",
+                     "Total time spent picking new commits from the output"),
+                    ("gittail_repo_bytes_total", "bytes_total", "counter",
+                     "Bytes of git output read"),
+                    ("gittail_repo_commits_parsed_total", "commits_parsed_total", "counter",
+                     "Commits read from the git output"),
+                    ("gittail_repo_new_commits_total", "new_commits_total", "counter",
+                     "Commits not seen before"),
+                    ("gittail_repo_errors_total", "errors_total", "counter",
+                     "Failed polls"),
+                    ("gittail_repo_last_success_timestamp", "last_success", "gauge",
+                     "Time of the latest successful poll")]:
+                metric(name, metric_type, help,
+                    [({"host": host, "spec": spec}, self.specs[(host, spec)][key])
+                     for host, spec in specs])
+
+            types = sorted(self.notifications.keys())
+            metric("gittail_notifications_total", "counter",
+                "Notifications sent",
+                [({"type": t}, self.notifications[t][0]) for t in types])
+            metric("gittail_notify_seconds_total", "counter",
+                "Total time spent sending notifications",
+                [({"type": t}, self.notifications[t][1]) for t in types])
+
+        return "\n".join(lines) + "\n"
+
+
+    """
+    Writes the Prometheus metrics to a file, replacing it atomically so that
+    a collector never reads a partial file
+    """
+    def write_prometheus(self, path):
+        tmp_path = "%s.tmp" % path
+        f = open(tmp_path, "w")
+        try:
+            f.write(self.prometheus())
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+
+    """
+    Serves the Prometheus metrics over HTTP from a background thread
+    """
+    def serve(self, port, address="127.0.0.1"):
+        import BaseHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((address, port), Handler)
+        thread = threading.Thread(target=server.serve_forever,
+            name="GitTail metrics")
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+def append_json_line(path, record):
+    f = open(path, "a")
+    try:
+        f.write(json.dumps(record) + "\n")
+    finally:
+        f.close()
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Profiling of poll cycles, started with --profile. A sampler records the call
+stacks of the threads doing GitTail's work, labelled by what they work on,
+e.g. "fetch example.com:/home/git/*.git", and writes them in the collapsed
+stack format read by flamegraph.pl and speedscope. Cumulative per function
+stats are computed from the samples, or measured with cProfile when
+profiling deterministically.
+"""
+
+import cProfile
+import os
+import pstats
+import sys
+import thread
+import threading
+import time
+
+
+# functions listed per label by the sampled stats
+LABEL_FUNCTIONS = 25
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+"""
+Returns the name of the function a frame runs, as shown in the stacks
+"""
+def _frame_name(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+        code.co_firstlineno)
+
+
+"""
+Profiles the poll cycles run between start() and stop(). Only the threads
+that have been given a label are sampled, so that threads waiting for
+something to do do not show up. With deterministic, the threads starting or
+running a poll cycle are also profiled with cProfile.
+"""
+class Profiler():
+    def __init__(self, deterministic=False, interval=0.005):
+        self.deterministic = deterministic
+        self.interval = interval
+        self.cycles = 0
+        self.samples = 0
+        # thread ident -> label
+        self.labels = {}
+        # (label, function names, outermost first) -> number of samples
+        self.stacks = {}
+        self._active = threading.Event()
+        self._closed = False
+        self._profiles = []
+        self._profiles_lock = threading.Lock()
+        self._profile = None
+        if deterministic:
+            self._profile = self._new_profile()
+
+        self._sampler = threading.Thread(target=self._sample,
+            name="GitTail profiler")
+        self._sampler.daemon = True
+        self._sampler.start()
+
+
+    """
+    Labels the work of the calling thread, or stops sampling it if label is
+    None. Returns the previous label.
+    """
+    def label(self, label):
+        ident = thread.get_ident()
+        previous = self.labels.get(ident)
+        if label is None:
+            self.labels.pop(ident, None)
+        else:
+            self.labels[ident] = label
+        return previous
+
+
+    def start(self):
+        if self._profile is not None:
+            threading.setprofile(self._profile_thread)
+            self._profile.enable()
+        self._active.set()
+
+
+    def stop(self):
+        self._active.clear()
+        if self._profile is not None:
+            self._profile.disable()
+            threading.setprofile(None)
+        self.cycles += 1
+
+
+    def close(self):
+        self._closed = True
+        self._active.set()
+        self._sampler.join()
+
+
+    def _new_profile(self):
+        profile = cProfile.Profile()
+        with self._profiles_lock:
+            self._profiles.append(profile)
+        return profile
+
+
+    """
+    Called by threading in threads started while profiling, to profile the
+    thread with a cProfile of its own
+    """
+    def _profile_thread(self, frame, event, arg):
+        sys.setprofile(None)
+        if threading.current_thread() is not self._sampler:
+            self._new_profile().enable()
+
+
+    def _sample(self):
+        own = thread.get_ident()
+        while True:
+            self._active.wait()
+            if self._closed:
+                return
+            time.sleep(self.interval)
+            if not self._active.is_set():
+                continue
+            for ident, frame in sys._current_frames().items():
+                label = self.labels.get(ident)
+                if ident == own or label is None:
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame))
+                    frame = frame.f_back
+                names.reverse()
+                key = (label, tuple(names))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+
+
+    """
+    Writes the samples to path in the collapsed stack format: one line per
+    stack, the label and the functions separated by semicolons, followed by
+    the number of samples
+    """
+    def write_collapsed(self, path):
+        f = open(path, "w")
+        try:
+            for (label, names), count in sorted(self.stacks.items()):
+                frames = [_encode(label)] + list(names)
+                line = ";".join([name.replace(";", ",") for name in frames])
+                f.write("%s %d\n" % (line, count))
+        finally:
+            f.close()
+
+
+    """
+    Writes the cumulative per function stats to path, and when profiling
+    deterministically also the raw cProfile stats to path with the
+    extension .pstats, for pstats or snakeviz
+    """
+    def write_stats(self, path):
+        f = open(path, "w")
+        try:
+            if self.deterministic:
+                with self._profiles_lock:
+                    profiles = list(self._profiles)
+                stats = pstats.Stats(profiles[0], stream=f)
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                f.write("%d poll cycles profiled with cProfile\n" % self.cycles)
+                stats.sort_stats("cumulative").print_stats()
+                stats.dump_stats(os.path.splitext(path)[0] + ".pstats")
+            else:
+                self._write_sampled_stats(f)
+        finally:
+            f.close()
+
+
+    """
+    Writes the share of samples in which each function was running
+    (cumulative) or on top of the stack (self), over all labels and for the
+    busiest functions of each label
+    """
+    def _write_sampled_stats(self, f):
+        f.write("%d poll cycles, %d samples taken every %.3f seconds\n" % (
+            self.cycles, self.samples, self.interval))
+        totals = {}
+        for (label, names), count in self.stacks.items():
+            totals[label] = totals.get(label, 0) + count
+        for label in [None] + sorted(totals.keys()):
+            cumulative = {}
+            own = {}
+            total = 0
+            for (stack_label, names), count in self.stacks.items():
+                if label is not None and stack_label != label:
+                    continue
+                total += count
+                for name in set(names):
+                    cumulative[name] = cumulative.get(name, 0) + count
+                own[names[-1]] = own.get(names[-1], 0) + count
+            names = sorted(cumulative.keys(), key=lambda name: -cumulative[name])
+            if label is None:
+                f.write("\nAll labels\n")
+            else:
+                f.write("\n%s\n" % _encode(label))
+                names = names[0:LABEL_FUNCTIONS]
+            f.write("%10s %10s %7s  %s\n" % ("samples", "self", "cum%", "function"))
+            for name in names:
+                f.write("%10d %10d %6.1f%%  %s\n" % (cumulative[name],
+                    own.get(name, 0), 100.0 * cumulative[name] / total, name))
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Shares one GitTail poller between many users. The server polls as usual,
+but instead of notifying it publishes the new commits to the subscribers
+connected at "host:port" or at the path of a Unix socket. Each subscriber
+sends the notifications locally, with its own templates and backends.
+
+Messages are JSON objects, one per line:
+
+    subscriber: {"type": "subscribe", "epoch": ID, "after": SEQ}
+    server:     {"type": "commits", "epoch": ID, "seq": SEQ,
+                 "first_run": BOOL, "commits": [...]}
+    server:     {"type": "replayed", "epoch": ID, "seq": SEQ}
+
+The server keeps the most recent batches of commits. A subscriber that
+connects is sent the batches it has not seen yet, followed by "replayed".
+Batches are numbered by seq within an epoch, which changes whenever the
+server restarts.
+"""
+
+import collections
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+import time
+
+from shard import JsonConnection, connect, listen
+
+
+class PublishServer():
+    def __init__(self, gittail, address, replay_size=100):
+        self.gittail = gittail
+        self.address = address
+        self.epoch = "%d.%d" % (time.time(), os.getpid())
+        self.seq = 0
+        self.replay = collections.deque(maxlen=replay_size)
+        # connection -> queue of messages to send
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        gittail.publish = self.publish
+
+
+    def start(self):
+        server = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                connection = JsonConnection(self.request)
+                try:
+                    message = connection.receive()
+                    if not message or message.get("type") != "subscribe":
+                        return
+                    queue = server.subscribe(connection, message)
+                    while True:
+                        message = queue.get()
+                        if message is None:
+                            break
+                        connection.send(message)
+                except (socket.error, ValueError):
+                    pass
+                finally:
+                    server.unsubscribe(connection)
+
+        self.server = listen(self.address, Handler)
+        thread = threading.Thread(target=self.server.serve_forever,
+            name="GitTail publisher")
+        thread.daemon = True
+        thread.start()
+        self.gittail.log("Publishing new commits at %s" % self.address)
+
+
+    def stop(self):
+        self.server.shutdown()
+        with self.lock:
+            for queue in self.subscribers.values():
+                queue.put(None)
+
+
+    """
+    Returns the queue of messages for a new subscriber, starting with the
+    batches it has missed
+    """
+    def subscribe(self, connection, message):
+        with self.lock:
+            after = message.get("after")
+            if message.get("epoch") != self.epoch:
+                after = None
+            # each subscriber is sent its messages by its own thread, so
+            # that one which stops reading does not hold up polling
+            queue = Queue.Queue(self.replay.maxlen + 1)
+            for batch in self.replay:
+                if after is None or batch["seq"] > after:
+                    queue.put(batch)
+            queue.put({"type": "replayed", "epoch": self.epoch, "seq": self.seq})
+            self.subscribers[connection] = queue
+            self.gittail.log("%d subscribers" % len(self.subscribers), 1)
+        return queue
+
+
+    def unsubscribe(self, connection):
+        with self.lock:
+            if self.subscribers.pop(connection, None) is None:
+                return
+            self.gittail.log("%d subscribers" % len(self.subscribers), 1)
+        connection.close()
+
+
+    def publish(self, commits, first_run):
+        if not commits and not first_run:
+            return
+        with self.lock:
+            self.seq += 1
+            batch = {"type": "commits", "epoch": self.epoch, "seq": self.seq,
+                "first_run": first_run,
+                "commits": [dict(commit) for commit in commits]}
+            self.replay.append(batch)
+            for connection, queue in self.subscribers.items():
+                try:
+                    queue.put_nowait(batch)
+                except Queue.Full:
+                    # too far behind, it catches up from the replay
+                    # buffer when it reconnects
+                    self.gittail.log("Dropping a subscriber that is not reading", 1)
+                    connection.close()
+            self.gittail.log("Published %d commits to %d subscribers" % (
+                len(commits), len(self.subscribers)), 2)
+
+
+class Subscriber():
+    def __init__(self, gittail, address):
+        self.gittail = gittail
+        self.address = address
+        self.epoch = None
+        self.seq = None
+
+
+    def run(self):
+        delay = 1
+        try:
+            while True:
+                try:
+                    connection = JsonConnection(connect(self.address))
+                except socket.error, e:
+                    self.gittail.log("Failed to connect to %s: %s" % (self.address, e))
+                    time.sleep(delay)
+                    delay = min(60, delay * 2)
+                    continue
+                delay = 1
+                self.gittail.log("Subscribed to %s" % self.address, 1)
+                try:
+                    self._receive(connection)
+                except (socket.error, ValueError), e:
+                    self.gittail.log("Lost connection to %s: %s" % (self.address, e))
+                finally:
+                    connection.close()
+                time.sleep(delay)
+        finally:
+            self.gittail.close()
+
+
+    def _receive(self, connection):
+        connection.send({"type": "subscribe", "epoch": self.epoch,
+            "after": self.seq})
+        # missed batches are notified together once all have arrived
+        replayed = []
+        replaying = True
+        while True:
+            message = connection.receive()
+            if message is None:
+                return
+            if message.get("type") == "replayed":
+                replaying = False
+                self.epoch = message["epoch"]
+                self.seq = message["seq"]
+                self._deliver(replayed)
+                replayed = []
+            elif message.get("type") == "commits":
+                if replaying:
+                    replayed.extend(message["commits"])
+                else:
+                    self.seq = message["seq"]
+                    self._deliver(message["commits"])
+
+
+    """
+    Notifies about the commits not notified yet. The first delivery is
+    notified like the first poll of GitTail.
+    """
+    def _deliver(self, commits):
+        new_commits = []
+        for commit in commits:
+            if commit["hash"] not in self.gittail.commits:
+                new_commits.append(commit)
+                self.gittail.commits.add(commit["hash"])
+        if new_commits or self.gittail.first_run:
+            self.gittail._notify_new_commits(new_commits)
+            self.gittail.save_state()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Recording of what GitTail's poll cycles read, and its replay, so that
+GitTail can be load tested and profiled offline against the traffic of a
+real installation.
+
+A recording is a gzip compressed file of JSON objects, one per line and
+poll cycle:
+
+    {"time": START, "jobs": [{"host": HOST, "seconds": SECONDS,
+        "specs": [{"key": KEY, "context": {...}, "output": OUTPUT}]}]}
+
+OUTPUT is what was read for the repo spec, in the format parsed by
+_read_git_log_records(), or null if polling it failed. SECONDS is how long
+the job took to run.
+"""
+
+import gzip
+import json
+import threading
+import time
+
+
+class Recorder():
+    def __init__(self, gittail, path):
+        self.gittail = gittail
+        self.path = path
+        # appending starts a new gzip member, which gzip reads as if
+        # the file was one
+        self.file = gzip.open(path, "ab")
+        self.lock = threading.Lock()
+        gittail.recorder = self
+
+
+    """
+    Appends a poll cycle started at start. results is a list of (job,
+    results of the job) pairs, as returned by _run_poll_jobs().
+    """
+    def record(self, start, results):
+        jobs = []
+        for job, job_results in results:
+            specs = []
+            for spec, result in zip(job["specs"], job_results):
+                output = None
+                if result is not None:
+                    output = self.gittail._format_git_log_records(result)
+                specs.append({"key": spec["key"], "context": spec["context"],
+                    "output": output})
+            jobs.append({"host": job["host"], "seconds": job["stats"]["seconds"],
+                "specs": specs})
+        line = json.dumps({"time": start, "jobs": jobs}) + "\n"
+        with self.lock:
+            self.file.write(line)
+            # keep the recording readable if GitTail is killed
+            self.file.flush()
+
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+"""
+Yields the poll cycles of the recording at path
+"""
+def read_recording(path):
+    f = gzip.open(path, "rb")
+    try:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        f.close()
+
+
+"""
+Runs the poll cycles of a recording through GitTail, so that the output read
+is parsed, new commits are picked and notified about as if it was read from
+the repos. With realtime, cycles start as far apart as they did when
+recorded and their jobs take as long, otherwise they run as fast as
+possible.
+"""
+class Replayer():
+    def __init__(self, gittail, path, realtime=True):
+        self.gittail = gittail
+        self.path = path
+        self.realtime = realtime
+
+
+    """
+    Replays the recording, or its first cycles poll cycles. Returns the
+    number of poll cycles replayed.
+    """
+    def run(self, cycles=None):
+        replayed = 0
+        first_start = None
+        replay_start = time.time()
+        for cycle in read_recording(self.path):
+            if cycles is not None and replayed >= cycles:
+                break
+            if first_start is None:
+                first_start = cycle["time"]
+            if self.realtime:
+                delay = replay_start + cycle["time"] - first_start - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self.gittail.log("Replaying the poll cycle of %s" % time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(cycle["time"])), 1)
+            self.gittail._poll([self._job(job) for job in cycle["jobs"]])
+            replayed += 1
+        self.gittail.log("Replayed %d poll cycles in %.3f seconds" % (
+            replayed, time.time() - replay_start), 1)
+        return replayed
+
+
+    def _job(self, job):
+        return {
+            "host": job["host"],
+            "specs": [{"key": spec["key"], "context": spec["context"]}
+                for spec in job["specs"]],
+            "fetch": lambda: self._fetch(job),
+        }
+
+
+    def _fetch(self, job):
+        if self.realtime:
+            time.sleep(job["seconds"])
+        results = []
+        for spec in job["specs"]:
+            if spec["output"] is None:
+                results.append(None)
+                continue
+            # framed like the output of a batch, so that the bytes read
+            # are counted for the right repo spec
+            lines = ["spec=%s\n" % spec["key"].encode('utf-8')]
+            lines.extend(spec["output"].encode('utf-8').splitlines(True))
+            results.append(list(self.gittail._read_git_log_records(
+                self.gittail._count_bytes(lines))))
+        return results
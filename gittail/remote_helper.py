@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+GitTail remote helper
+
+Installed by GitTail on SSH hosts with "ssh_helper" enabled, and run there
+on every poll instead of the shell loop built by _repo_iteration_command().
+It reads the refs of every repo directly from disk, remembers them between
+polls on the remote host, and runs git log only in repos whose refs have
+changed, listing only the commits added since the previous poll.
+
+    python remote_helper.py CLIENT_ID CURSOR BASE_PATH PATTERN FORMAT
+
+CLIENT_ID names the state file of the polling client, CURSOR is the cursor
+printed by the previous poll (or "-"), and FORMAT is the git log
+--pretty=format string. Prints the same repo=/commit= records as the shell
+loop, repo= for every repo and commit= only for repos whose refs changed,
+followed by "cursor=NEW_CURSOR".
+
+Runs on Python 2.6 and later, including Python 3, and must not import
+anything from GitTail.
+"""
+
+import glob
+import json
+import os
+import subprocess
+import sys
+
+STATE_DIR = os.path.expanduser("~/.gittail")
+
+# Time period to watch in repos without a previous state
+SINCE = "1 day ago"
+
+
+def git_dir(path):
+    if os.path.isdir(os.path.join(path, ".git")):
+        return os.path.join(path, ".git")
+    return path
+
+
+def is_repo(path):
+    return os.path.isdir(path) and (
+        path.endswith(".git") or os.path.isdir(os.path.join(path, ".git")))
+
+
+"""
+Returns the sorted list of hashes that refs and HEAD of a repo point to
+"""
+def ref_tips(path):
+    tips = set()
+    gitdir = git_dir(path)
+
+    try:
+        packed_refs = open(os.path.join(gitdir, "packed-refs"))
+        try:
+            for line in packed_refs:
+                if line[0] not in "#^" and len(line) > 40:
+                    tips.add(line[0:40])
+        finally:
+            packed_refs.close()
+    except IOError:
+        pass
+
+    loose_refs = [os.path.join(gitdir, "HEAD")]
+    for root, dirs, files in os.walk(os.path.join(gitdir, "refs")):
+        for name in files:
+            if not name.endswith(".lock"):
+                loose_refs.append(os.path.join(root, name))
+    for ref in loose_refs:
+        try:
+            f = open(ref)
+            try:
+                value = f.read(41).strip()
+            finally:
+                f.close()
+        except IOError:
+            continue
+        # symbolic refs ("ref: refs/heads/master") point to refs read anyway
+        if len(value) == 40:
+            tips.add(value)
+
+    return sorted(tips)
+
+
+def load_state(client_id):
+    try:
+        f = open(os.path.join(STATE_DIR, "state-%s.json" % client_id))
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(client_id, state):
+    path = os.path.join(STATE_DIR, "state-%s.json" % client_id)
+    f = open(path + ".tmp", "w")
+    try:
+        json.dump(state, f)
+    finally:
+        f.close()
+    os.rename(path + ".tmp", path)
+
+
+def write(text):
+    if sys.version_info[0] >= 3:
+        sys.stdout.buffer.write(text.encode("utf-8"))
+    else:
+        sys.stdout.write(text)
+
+
+def main(args):
+    client_id, cursor, base_path, pattern, log_format = args
+
+    state = load_state(client_id)
+    # tips per repo as of the cursor the client has seen; unknown cursors
+    # (e.g. a client that lost its state) start from scratch
+    known = state.get(cursor, {})
+
+    if base_path:
+        os.chdir(os.path.expanduser(base_path))
+
+    tips = {}
+    for repo in sorted(glob.glob(pattern)):
+        if not is_repo(repo):
+            continue
+        tips[repo] = ref_tips(repo)
+        # every repo is listed, so that the client knows which repos exist
+        write("repo=%s\n" % repo)
+        if tips[repo] == known.get(repo):
+            continue
+
+        sys.stdout.flush()
+        command = ["git", "log", "--pretty=format:%s%%n" % log_format]
+        if repo in known:
+            command += ["--ignore-missing", "--all", "--not"] + known[repo]
+        else:
+            command += ["--all", "--since=%s" % SINCE]
+        subprocess.call(command, cwd=repo)
+        write("\n")
+
+    try:
+        new_cursor = str(int(cursor) + 1)
+    except ValueError:
+        new_cursor = "1"
+    # keep the previous cursor as well, in case the client never
+    # receives this response and asks again
+    new_state = {new_cursor: tips}
+    if cursor in state:
+        new_state[cursor] = state[cursor]
+    if not os.path.isdir(STATE_DIR):
+        os.makedirs(STATE_DIR)
+    save_state(client_id, new_state)
+
+    write("cursor=%s\n" % new_cursor)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
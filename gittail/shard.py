@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Sharded polling: several GitTail worker processes each poll a share of the
+repo specs and send the new commits they find to a coordinator, which
+removes duplicates, decides about digests and sends the notifications.
+
+Repo specs are assigned to workers by consistent hashing, so when a worker
+joins or leaves only the repo specs of that worker change hands. Workers
+and the coordinator must use the same ssh_hosts and local_repos settings.
+
+Workers connect to the coordinator at "host:port" or at the path of a Unix
+socket, and exchange JSON objects, one per line:
+
+    worker:      {"type": "hello", "worker": "ID"}
+    coordinator: {"type": "assign", "specs": ["SPEC KEY", ...]}
+    worker:      {"type": "commits", "first_run": BOOL, "commits": [...]}
+"""
+
+import bisect
+import hashlib
+import json
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+import time
+
+
+"""
+Consistent hash ring with replicas points per node
+"""
+class HashRing():
+    def __init__(self, replicas=64):
+        self.replicas = replicas
+        self._points = []
+        self._nodes = {}
+
+
+    def _hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[0:16], 16)
+
+
+    def add(self, node):
+        for i in range(0, self.replicas):
+            point = self._hash("%s#%d" % (node, i))
+            bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+
+    def remove(self, node):
+        for i in range(0, self.replicas):
+            point = self._hash("%s#%d" % (node, i))
+            index = bisect.bisect_left(self._points, point)
+            if index < len(self._points) and self._points[index] == point:
+                del self._points[index]
+                del self._nodes[point]
+
+
+    def node(self, key):
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._nodes[self._points[index]]
+
+
+"""
+Parses "host:port" into a TCP address, and anything else into the path of
+a Unix socket
+"""
+def parse_address(address):
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    return socket.AF_UNIX, address
+
+
+def connect(address):
+    family, address = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+"""
+A threading TCP server that can be restarted right away on the same port
+"""
+class ReusableTCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+
+
+def listen(address, handler):
+    family, address = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.remove(address)
+        server_class = SocketServer.ThreadingUnixStreamServer
+    else:
+        server_class = ReusableTCPServer
+    server = server_class(address, handler)
+    server.daemon_threads = True
+    return server
+
+
+"""
+A socket sending and receiving JSON objects, one per line
+"""
+class JsonConnection():
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile("r")
+        self.lock = threading.Lock()
+
+
+    def send(self, message):
+        line = json.dumps(message) + "\n"
+        with self.lock:
+            self.sock.sendall(line)
+
+
+    """
+    Returns the next message, or None when the connection has been closed
+    """
+    def receive(self):
+        line = self.reader.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class Coordinator():
+    def __init__(self, gittail, address):
+        self.gittail = gittail
+        self.address = address
+        self.spec_keys = gittail.repo_spec_keys()
+        self.ring = HashRing()
+        self.lock = threading.Lock()
+        # worker id -> JsonConnection
+        self.workers = {}
+        self.assignments = {}
+        self.batches = Queue.Queue()
+        # workers whose first batch is awaited before the first run digest
+        self._first_run_pending = None
+        self._first_run_commits = []
+        self._first_run_deadline = None
+
+
+    def add_worker(self, worker_id, connection):
+        with self.lock:
+            if self.workers.has_key(worker_id):
+                self.workers[worker_id].close()
+            else:
+                self.ring.add(worker_id)
+            self.workers[worker_id] = connection
+            self.gittail.log("Worker %s joined" % worker_id)
+            self._rebalance()
+
+
+    def remove_worker(self, worker_id, connection):
+        with self.lock:
+            if self.workers.get(worker_id) is not connection:
+                return
+            del self.workers[worker_id]
+            self.ring.remove(worker_id)
+            self.gittail.log("Worker %s left" % worker_id)
+            self._rebalance()
+        self.batches.put((worker_id, None))
+
+
+    """
+    Assigns every repo spec to a worker, and sends the workers whose
+    share has changed their new share
+    """
+    def _rebalance(self):
+        assignments = {}
+        for worker_id in self.workers:
+            assignments[worker_id] = []
+        for key in self.spec_keys:
+            worker_id = self.ring.node(key)
+            if worker_id is not None:
+                assignments[worker_id].append(key)
+
+        moved = 0
+        for worker_id in assignments:
+            old = set(self.assignments.get(worker_id, []))
+            moved += len(set(assignments[worker_id]) - old)
+            if set(assignments[worker_id]) != old or not self.assignments.has_key(worker_id):
+                try:
+                    self.workers[worker_id].send(
+                        {"type": "assign", "specs": assignments[worker_id]})
+                except socket.error:
+                    pass
+        self.assignments = assignments
+        self.gittail.log("%d repo specs assigned to %d workers, %d moved" % (
+            len(self.spec_keys), len(self.workers), moved), 1)
+
+
+    def serve_forever(self):
+        coordinator = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                connection = JsonConnection(self.request)
+                hello = connection.receive()
+                if not hello or hello.get("type") != "hello":
+                    return
+                worker_id = hello["worker"]
+                coordinator.add_worker(worker_id, connection)
+                try:
+                    while True:
+                        message = connection.receive()
+                        if message is None:
+                            break
+                        if message.get("type") == "commits":
+                            coordinator.batches.put((worker_id, message))
+                except (socket.error, ValueError):
+                    pass
+                finally:
+                    coordinator.remove_worker(worker_id, connection)
+
+        server = listen(self.address, Handler)
+        thread = threading.Thread(target=server.serve_forever,
+            name="GitTail coordinator")
+        thread.daemon = True
+        thread.start()
+        self.gittail.log("Coordinating workers at %s" % self.address)
+
+        try:
+            while True:
+                # Queue.get() without a timeout cannot be interrupted
+                timeout = 3600
+                if self._first_run_deadline is not None:
+                    timeout = max(0.1, self._first_run_deadline - time.time())
+                try:
+                    worker_id, message = self.batches.get(True, timeout)
+                except Queue.Empty:
+                    worker_id, message = None, None
+                self._handle(worker_id, message)
+        finally:
+            server.shutdown()
+            self.gittail.close()
+
+
+    def _handle(self, worker_id, message):
+        if message is not None:
+            new_commits = []
+            for commit in message["commits"]:
+                if commit["hash"] not in self.gittail.commits:
+                    new_commits.append(commit)
+                    self.gittail.commits.add(commit["hash"])
+            self.gittail.log("Worker %s found %d commits, %d new" % (
+                worker_id, len(message["commits"]), len(new_commits)), 2)
+        else:
+            new_commits = []
+
+        if self.gittail.first_run:
+            # collect the first batch of every worker into one digest
+            if self._first_run_pending is None:
+                with self.lock:
+                    self._first_run_pending = set(self.workers.keys())
+                self._first_run_deadline = time.time() + \
+                    2 * self.gittail._config("poll_interval", 60)
+            self._first_run_commits.extend(new_commits)
+            if message is not None or worker_id is not None:
+                self._first_run_pending.discard(worker_id)
+            if self._first_run_pending and time.time() < self._first_run_deadline:
+                return
+            new_commits = self._first_run_commits
+            self._first_run_commits = []
+            self._first_run_deadline = None
+        elif message is None:
+            return
+
+        self.gittail._notify_new_commits(new_commits)
+        self.gittail.save_state()
+
+
+class ShardWorker():
+    def __init__(self, gittail, address, worker_id=None):
+        self.gittail = gittail
+        self.address = address
+        self.worker_id = worker_id or "%s:%d" % (socket.gethostname(), os.getpid())
+        self.connection = None
+        self.assigned = threading.Event()
+        # batches not yet delivered to the coordinator
+        self.outbox = []
+        gittail.shard = set()
+        gittail.publish = self.publish
+
+
+    def _connect(self):
+        delay = 1
+        while self.connection is None:
+            try:
+                self.connection = JsonConnection(connect(self.address))
+                self.connection.send({"type": "hello", "worker": self.worker_id})
+            except socket.error, e:
+                self.connection = None
+                self.gittail.log("Failed to connect to coordinator at %s: %s" % (
+                    self.address, e))
+                time.sleep(delay)
+                delay = min(60, delay * 2)
+
+        self.gittail.log("Connected to coordinator at %s" % self.address, 1)
+        reader = threading.Thread(target=self._read, args=(self.connection,),
+            name="GitTail worker")
+        reader.daemon = True
+        reader.start()
+
+
+    def _read(self, connection):
+        try:
+            while True:
+                message = connection.receive()
+                if message is None:
+                    break
+                if message.get("type") == "assign":
+                    self.gittail.shard = set(message["specs"])
+                    self.gittail.log("Assigned %d repo specs" % len(message["specs"]), 1)
+                    self.assigned.set()
+        except (socket.error, ValueError):
+            pass
+        self.gittail.log("Lost connection to coordinator")
+        self.gittail.shard = set()
+        self.assigned.clear()
+        if self.connection is connection:
+            self.connection = None
+
+
+    def publish(self, commits, first_run):
+        self.outbox.append({"type": "commits", "first_run": first_run,
+            "commits": [dict(commit) for commit in commits]})
+        self._flush()
+
+
+    def _flush(self):
+        while self.outbox and self.connection is not None:
+            try:
+                self.connection.send(self.outbox[0])
+            except socket.error:
+                self.connection = None
+                return
+            self.outbox.pop(0)
+
+
+    def run(self):
+        try:
+            while True:
+                if self.connection is None:
+                    self._connect()
+                    self._flush()
+                if not self.assigned.wait(10):
+                    continue
+                if not self.gittail.poll():
+                    return
+                self.gittail.wait_for_next_poll()
+        finally:
+            if self.connection is not None:
+                self.connection.close()
+            self.gittail.close()
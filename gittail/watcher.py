@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Watches the refs of local repositories using Linux inotify, so that GitTail
+can poll a repository as soon as something has been pushed to it.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# Git updates refs by writing a lock file and renaming it into place
+REF_EVENTS = (IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF)
+
+# Files directly in the git directory whose changes move refs
+GIT_DIR_FILES = ('HEAD', 'packed-refs')
+
+_event_header = struct.Struct("iIII")
+
+
+class RepoWatcher():
+    def __init__(self, debounce=0.5):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except AttributeError:
+            raise OSError("libc does not support inotify")
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.debounce = debounce
+        # watch descriptor -> (key, path, is git directory)
+        self._watches = {}
+        # key -> watch descriptors
+        self._keys = {}
+
+
+    """
+    Watches the refs of the repository at path. Changes to them are
+    reported by wait() as key.
+    """
+    def watch(self, key, path):
+        if self._keys.has_key(key):
+            return True
+        git_dir = os.path.join(path, ".git")
+        if not os.path.isdir(git_dir):
+            git_dir = path
+        if not os.path.isdir(os.path.join(git_dir, "refs")):
+            return False
+
+        self._keys[key] = []
+        self._add(key, git_dir, True)
+        for root, dirs, files in os.walk(os.path.join(git_dir, "refs")):
+            self._add(key, root, False)
+        return True
+
+
+    def _add(self, key, path, is_git_dir):
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+        wd = self._add_watch(self.fd, path, REF_EVENTS)
+        if wd < 0:
+            return
+        self._watches[wd] = (key, path, is_git_dir)
+        self._keys[key].append(wd)
+
+
+    """
+    Stops watching all repositories whose key is not in keys
+    """
+    def retain(self, keys):
+        for key in self._keys.keys():
+            if key not in keys:
+                for wd in self._keys.pop(key):
+                    self._rm_watch(self.fd, wd)
+                    self._watches.pop(wd, None)
+
+
+    """
+    Waits at most timeout seconds for refs to change. Once a change has been
+    seen, waits until there has been no change for debounce seconds, so that
+    a push updating many refs is reported once. Returns the set of keys of
+    the repositories that changed.
+    """
+    def wait(self, timeout):
+        changed = set()
+        deadline = time.time() + timeout
+        while True:
+            if changed:
+                wait_for = self.debounce
+            else:
+                wait_for = deadline - time.time()
+                if wait_for <= 0:
+                    return changed
+            try:
+                readable = select.select([self.fd], [], [], wait_for)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                return changed
+            changed.update(self._read())
+
+
+    def _read(self):
+        changed = set()
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return changed
+            raise
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+
+            if not self._watches.has_key(wd):
+                continue
+            key, path, is_git_dir = self._watches[wd]
+
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                if self._keys.has_key(key) and wd in self._keys[key]:
+                    self._keys[key].remove(wd)
+                continue
+
+            if is_git_dir and name not in GIT_DIR_FILES:
+                continue
+            if name.endswith(".lock"):
+                continue
+            if mask & IN_CREATE and mask & IN_ISDIR:
+                # new ref namespace, e.g. refs/heads/feature/
+                self._add(key, os.path.join(path, name), False)
+            changed.add(key)
+        return changed
+
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Tests of the native local repository reader, see gitobjects.py. The records
+and commits it reads are compared with those the git log path of GitTail
+reads from the same fixture repos, which cover loose and packed objects,
+ofs and ref deltas, annotated tags, merges and non-utf-8 commit messages.
+
+    python tests/test_gitobjects.py
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+tests_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(tests_path, "..", "gittail"))
+
+from gittail import GitTail
+from gitobjects import ObjectCache, Repository
+
+
+def has_git():
+    try:
+        subprocess.check_output(["git", "--version"])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+"""
+Builds the fixture repos in path: "work", a repo with a working tree whose
+history is packed with ofs deltas, with loose objects and refs added on top,
+and "bare.git", a bare clone of it packed with ref deltas
+"""
+class Fixture():
+    def __init__(self, path):
+        self.path = path
+        self.work = os.path.join(path, "work")
+        self.bare = os.path.join(path, "bare.git")
+        # commit dates, one minute apart, all within the last day
+        self.date = int(time.time()) - 12 * 3600
+
+        self.git(path, "init", "-q", "work")
+        self.git(self.work, "config", "user.name", "Alice")
+        self.git(self.work, "config", "user.email", "alice@example.com")
+        self.git(self.work, "checkout", "-q", "-b", "master")
+        for i in range(0, 12):
+            self.commit(self.work, "Change %d" % i)
+        self.git(self.work, "checkout", "-q", "-b", "feature", "HEAD~3")
+        for i in range(0, 3):
+            self.commit(self.work, "Feature %d" % i, author="Bob <bob@example.com>",
+                notes="feature")
+        self.git(self.work, "checkout", "-q", "master")
+        self.commit(self.work, "Subject on\ntwo lines\n\nand a body")
+        self.merge(self.work, "feature")
+        self.git(self.work, "tag", "-a", "-m", "Release 1", "v1", "HEAD~2")
+        self.git(self.work, "tag", "light", "HEAD~1")
+        self.commit(self.work, "Caf\xe9 in Latin-1", encoding="ISO-8859-1")
+        # similar commits and tags in one pack are stored as deltas
+        self.git(self.work, "repack", "-q", "-a", "-d", "-f", "--window=250",
+            "--depth=50")
+        self.git(self.work, "pack-refs", "--all")
+        self.commit(self.work, "Loose change")
+        self.git(self.work, "tag", "-a", "-m", "Release 2", "v2")
+
+        self.git(path, "clone", "-q", "--bare", "work", "bare.git")
+        self.git(self.bare, "-c", "repack.useDeltaBaseOffset=false", "repack",
+            "-q", "-a", "-d", "-f", "--window=250", "--depth=50")
+
+
+    def git(self, cwd, *args, **kwargs):
+        env = dict(os.environ)
+        env.update(kwargs.get("env", {}))
+        return subprocess.check_output(("git",) + args, cwd=cwd, env=env)
+
+
+    def dates(self):
+        self.date += 60
+        date = "%d +0000" % self.date
+        return {"GIT_AUTHOR_DATE": date, "GIT_COMMITTER_DATE": date}
+
+
+    """
+    Commits a change of the file notes growing with every commit, with a
+    long, repetitive message so that the commit objects get deltified too
+    """
+    def commit(self, cwd, subject, author=None, encoding=None, notes="notes"):
+        f = open(os.path.join(cwd, notes), "a")
+        f.write("%s\n" % subject)
+        f.close()
+        self.git(cwd, "add", notes)
+        message = os.path.join(self.path, "message")
+        f = open(message, "w")
+        f.write("%s\n\n%s\n" % (subject, "The same long explanation. " * 20))
+        f.close()
+        args = ["commit", "-q", "-F", message]
+        if author is not None:
+            args += ["--author", author]
+        if encoding is not None:
+            args = ["-c", "i18n.commitEncoding=%s" % encoding] + args
+        self.git(cwd, *args, env=self.dates())
+
+
+    def merge(self, cwd, branch):
+        self.git(cwd, "merge", "-q", "--no-ff", "-m", "Merge %s" % branch,
+            branch, env=self.dates())
+
+
+    """
+    Returns the number of deltified commit and tag objects in the packs
+    of a repo
+    """
+    def deltified(self, git_dir):
+        count = 0
+        pack_dir = os.path.join(git_dir, "objects", "pack")
+        for name in os.listdir(pack_dir):
+            if name.endswith(".idx"):
+                output = self.git(pack_dir, "verify-pack", "-v", name)
+                for line in output.splitlines():
+                    fields = line.split()
+                    if len(fields) == 7 and fields[1] in ("commit", "tag"):
+                        count += 1
+        return count
+
+
+@unittest.skipUnless(has_git(), "git is not installed")
+class NativeReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="gittail-test-")
+        self.fixture = Fixture(self.path)
+        self.spec = {"base_path": self.path, "pattern": "*"}
+
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+    def gittail(self, native):
+        return GitTail(config={
+            "local_repos": [self.spec],
+            "native_local_reader": native,
+            "watch_local_repos": False,
+            "use_growl": False,
+            "use_libnotify": False,
+            "verbosity": -1,
+        })
+
+
+    """
+    Returns the records GitTail reads from a repo with the native reader,
+    which must support it, and with git, as lists of tuples
+    """
+    def records(self, name):
+        native = self.gittail(True)
+        spec_key = native._repo_spec_key(self.spec)
+        native_records = native._read_local_repository(
+            os.path.join(self.path, name), name,
+            native.ref_fingerprints.get(spec_key) or {},
+            native.ref_tips.get(spec_key, {}), time.time() - 86400)
+        git = self.gittail(False)
+        git_records = git._fetch_repo_spec(git._run_local_command, self.spec,
+            repo_names=[name])
+        return [self.plain(record) for record in native_records], \
+            [self.plain(record) for record in git_records]
+
+
+    def plain(self, record):
+        if record[0] == 'commit':
+            return ('commit', dict(record[1]))
+        return record
+
+
+    def test_fixture(self):
+        self.assertTrue(self.fixture.deltified(os.path.join(self.fixture.work, ".git")))
+        self.assertTrue(self.fixture.deltified(self.fixture.bare))
+        self.assertTrue(os.path.exists(os.path.join(self.fixture.work, ".git",
+            "packed-refs")))
+
+
+    def test_refs(self):
+        for git_dir in [os.path.join(self.fixture.work, ".git"), self.fixture.bare]:
+            repository = Repository(git_dir, ObjectCache(), ObjectCache(256))
+            refs = repository.refs()
+            show_ref = subprocess.check_output(["git", "show-ref", "--head"],
+                cwd=git_dir)
+            self.assertEqual("".join(["%s %s\n" % (sha, name) for name, sha in refs]),
+                show_ref)
+            cksum = subprocess.check_output("git show-ref --head | cksum",
+                shell=True, cwd=git_dir).strip()
+            self.assertEqual(repository.fingerprint(refs), cksum)
+
+
+    def test_first_poll(self):
+        for name in ["work", "bare.git"]:
+            native_records, git_records = self.records(name)
+            self.assertEqual(native_records, git_records)
+            commits = [value for record_type, value in native_records
+                if record_type == 'commit']
+            subjects = [commit['subject'] for commit in commits]
+            self.assertEqual(len(commits), 19)
+            self.assertTrue(u"Caf\xe9 in Latin-1" in subjects)
+            self.assertTrue(u"Subject on two lines" in subjects)
+            self.assertTrue(u"Merge feature" in subjects)
+            self.assertTrue("Bob" in [commit['author'] for commit in commits])
+
+
+    def test_incremental_poll(self):
+        native = self.gittail(True)
+        git = self.gittail(False)
+        for gittail in [native, git]:
+            gittail._parse_git_log_result(gittail._fetch_local_repo(self.spec),
+                repo=self.spec)
+
+        work = self.fixture.work
+        self.fixture.git(work, "checkout", "-q", "-b", "topic", "HEAD~4")
+        self.fixture.commit(work, "Topic change", author="Bob <bob@example.com>",
+            notes="topic")
+        self.fixture.git(work, "checkout", "-q", "master")
+        self.fixture.commit(work, "Master change")
+        self.fixture.merge(work, "topic")
+        self.fixture.git(work, "tag", "-a", "-m", "Release 3", "v3")
+        self.fixture.git(work, "push", "-q", self.fixture.bare, "master", "topic",
+            "v3")
+
+        results = []
+        for gittail in [native, git]:
+            commits = gittail._parse_git_log_result(
+                gittail._fetch_local_repo(self.spec), repo=self.spec)
+            results.append([dict(commit) for commit in commits])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(sorted([commit['subject'] for commit in results[0]]),
+            [u"Master change", u"Merge topic", u"Topic change"])
+        self.assertEqual(native.ref_fingerprints, git.ref_fingerprints)
+        self.assertEqual(native.ref_tips, git.ref_tips)
+
+
+if __name__ == "__main__":
+    unittest.main()
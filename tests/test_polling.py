@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013 Tom Sundström (office@tomsun.ax)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Tests of polling local repo specs with git, see GitTail._fetch_repo_specs().
+The fixture repos are those of test_gitobjects.py.
+
+    python tests/test_polling.py
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+tests_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(tests_path, "..", "gittail"))
+
+from gittail import GitTail
+from test_gitobjects import Fixture, has_git
+
+
+@unittest.skipUnless(has_git(), "git is not installed")
+class PollingTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="gittail-test-")
+        self.fixture = Fixture(self.path)
+        self.specs = [{"base_path": self.path, "pattern": "work"},
+            {"base_path": self.path, "pattern": "bare.git"}]
+        self.gittail = GitTail(config={
+            "local_repos": self.specs,
+            "native_local_reader": False,
+            "watch_local_repos": False,
+            "use_growl": False,
+            "use_libnotify": False,
+            "verbosity": -1,
+        })
+
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+    def poll(self):
+        results = self.gittail._fetch_repo_specs(self.gittail._run_local_command,
+            self.specs)
+        commits = []
+        for spec, records in zip(self.specs, results):
+            self.assertTrue(records is not None)
+            commits.extend(self.gittail._parse_git_log_result(records, repo=spec))
+        return [commit['subject'] for commit in commits]
+
+
+    """
+    The known refs, tips and names of hosts with thousands of repos are far
+    larger than a single command line argument may be
+    """
+    def test_large_batch(self):
+        self.assertEqual(len(self.poll()), 19)
+        for spec in self.specs:
+            spec_key = self.gittail._repo_spec_key(spec)
+            for i in range(0, 4000):
+                name = "unrelated-repository-with-a-long-name-%d" % i
+                self.gittail.ref_fingerprints[spec_key][name] = "1234567890 1234"
+                self.gittail.ref_tips[spec_key][name] = ["0" * 40]
+
+        self.assertEqual(self.poll(), [])
+        self.fixture.commit(self.fixture.work, "Master change")
+        self.assertEqual(self.poll(), [u"Master change"])
+
+
+if __name__ == "__main__":
+    unittest.main()